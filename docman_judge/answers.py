@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Set, Union
+
+from docman_judge import lookup
+from docman_judge.correct import Answer, transform_article
+from docman_judge.profiling import span
+
+
+# Expected outputs keyed by the content hash of (input, citation), so identical inputs are only solved once.
+# Book and webpage lines come from the metadata API, so the endpoint they were looked up at is hashed too.
+# With a path, the store is loaded from and saved to a JSON file to be reused by later runs;
+# only answers used by the current run are saved, so the file doesn't grow with every random case set.
+class AnswerStore:
+    def __init__(self, path: Union[None, str, Path] = None) -> None:
+        self.path = path
+        self.answers: Dict[str, Answer] = {}
+        self.used: Set[str] = set()
+        if path is not None and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.answers = {key: Answer(*value) for key, value in json.load(f).items()}
+
+    @staticmethod
+    def key(input_str: str, citation_path: Union[str, Path]) -> str:
+        digest = hashlib.sha256(lookup.lookup_cache.endpoint.encode() + b"\0")
+        digest.update(input_str.encode("utf-8", errors="surrogatepass"))
+        digest.update(b"\0")
+        with open(citation_path, "rb") as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def get(self, input_str: str, citation_path: Union[str, Path]) -> Answer:
+        key = self.key(input_str, citation_path)
+        self.used.add(key)
+        if key not in self.answers:
+            with span("transform_article", "reference", citation=os.path.basename(citation_path)):
+                self.answers[key] = transform_article(input_str, citation_path)
+        return self.answers[key]
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({key: [self.answers[key].result, self.answers[key].success] for key in self.used}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,272 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from importlib.resources import files
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+
+from docman_judge.answers import AnswerStore
+from docman_judge.cases import generate_random_files, get_cases
+from docman_judge.judge import JudgeResult, build
+from docman_judge.log import JsonLinesLogger, JsonLogger, MemoryLogger, TermLogger
+from docman_judge.lookup import LookupCache, citation_lookup_keys, set_lookup_cache
+from docman_judge.main import JudgeOptions, judge
+from docman_judge.stub_api import StubApi
+
+# Benchmarks of the judge itself, end to end, against stub `docman` programs and a local stand-in of the
+# metadata API, so the numbers only depend on this machine and on the judge. POSIX only: the stubs are
+# Python scripts installed as build/docman.
+#
+#     python -m docman_judge.bench --jobs 4
+#
+# Every run is appended to a JSON Lines history file and compared with the previous run of the same setup.
+
+CASE_SEED = 0  # every run judges the same generated cases, so runs compare
+
+SCENARIOS = {
+    "correct": "prints the right answer",
+    "slow": "prints the right answer after sleeping 0.2s",
+    "flood": "prints its answer over and over until it is killed",
+}
+
+STUB_DOCMAN = """#!{python}
+import os
+import sys
+import time
+
+sys.path.insert(0, {package_root!r})
+from docman_judge.correct import transform_article
+from docman_judge.lookup import LookupCache, set_lookup_cache
+
+set_lookup_cache(LookupCache(endpoint={endpoint!r}))
+MODE = {mode!r}
+
+
+def main(argv):
+    citation = output = article = None
+    i = 0
+    while i < len(argv):
+        if argv[i] in ("-c", "-o"):
+            if i + 1 == len(argv) or (argv[i] == "-c" and citation) or (argv[i] == "-o" and output):
+                return 1
+            if argv[i] == "-c":
+                citation = argv[i + 1]
+            else:
+                output = argv[i + 1]
+            i += 2
+        elif argv[i].startswith("-") and argv[i] != "-" or article is not None:
+            return 1
+        else:
+            article = argv[i]
+            i += 1
+    if citation is None or article is None or not os.path.isfile(citation):
+        return 1
+    try:
+        if article == "-":
+            text = sys.stdin.read()
+        else:
+            with open(article, encoding="utf-8") as f:
+                text = f.read()
+        answer = transform_article(text, citation)
+    except Exception:
+        return 1
+    if not answer.success:
+        return 1
+    if MODE == "slow":
+        time.sleep(0.2)
+    if MODE == "flood":
+        while True:
+            sys.stdout.write(answer.result)
+    if output is None:
+        sys.stdout.write(answer.result + "\\n")
+    else:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(answer.result)
+    return 0
+
+
+sys.exit(main(sys.argv[1:]))
+"""
+
+STUB_CMAKELISTS = """cmake_minimum_required(VERSION 3.20)
+project(docman NONE)
+configure_file(docman.py docman COPYONLY FILE_PERMISSIONS OWNER_READ OWNER_WRITE OWNER_EXECUTE)
+"""
+
+
+def make_stub_workspace(path: Path, mode: str, endpoint: str) -> Path:
+    path.mkdir(parents=True, exist_ok=True)
+    package_root = str(Path(__file__).resolve().parent.parent)
+    (path / "docman.py").write_text(
+        STUB_DOCMAN.format(python=sys.executable, package_root=package_root, endpoint=endpoint, mode=mode)
+    )
+    (path / "CMakeLists.txt").write_text(STUB_CMAKELISTS)
+    return path
+
+
+def max_rss() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Phases:
+    def __init__(self) -> None:
+        self.phases: Dict[str, Dict[str, float]] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        time_start, cpu_start = time.perf_counter(), children_cpu()
+        yield
+        self.phases[name] = {
+            "wall_time": time.perf_counter() - time_start,
+            "children_cpu": children_cpu() - cpu_start,
+            "max_rss": max_rss(),  # of the judge process so far, KiB
+        }
+
+
+def bench_scenario(mode: str, workdir: Path, endpoint: str, jobs: int) -> dict:
+    data = files("docman_judge.data")
+    phases = Phases()
+
+    with phases.phase("setup"):
+        input_dir, citation_dir = workdir / "inputs", workdir / "citations"
+        shutil.copytree(data / "inputs", input_dir)
+        shutil.copytree(data / "citations", citation_dir)
+    with phases.phase("generate"):
+        generate_random_files(input_dir, citation_dir, CASE_SEED)
+    with phases.phase("prefetch"):
+        lookup_cache = LookupCache(endpoint=endpoint)
+        set_lookup_cache(lookup_cache)
+        lookup_cache.prefetch(citation_lookup_keys(citation_dir))
+    with phases.phase("answers"):
+        cases = get_cases(input_dir, citation_dir, AnswerStore())
+
+    workspace = make_stub_workspace(workdir / f"workspace-{mode}", mode, endpoint)
+    with phases.phase("build"):
+        build_result = build(str(workspace))
+    assert build_result.success, build_result.log
+
+    logger = MemoryLogger()
+    with phases.phase("test"):
+        judge(str(workspace), cases, logger, JudgeOptions(jobs=jobs, verbose=False))
+    test_results = [result for result in logger.results if result.case is not None]
+
+    return {
+        "cases": len(cases),
+        "passed": sum(result.success for result in test_results),
+        "cases_per_second": len(cases) / phases.phases["test"]["wall_time"],
+        "phases": phases.phases,
+    }
+
+
+# Seconds each logger takes for `count` results carrying a few KiB of log each, half of them failed.
+def bench_loggers(workdir: Path, count: int = 2000) -> Dict[str, float]:
+    results = [
+        JudgeResult("test", i % 2 == 0, "output\n" * 400, {"wall_time": 0.1}, case=f"{i}.txt:file-stdout")
+        for i in range(count)
+    ]
+    loggers = {
+        "term": TermLogger(),
+        "json": JsonLogger(str(workdir / "log.json")),
+        "jsonl": JsonLinesLogger(str(workdir / "log.jsonl")),
+    }
+    timings = {}
+    for name, logger in loggers.items():
+        time_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            logger.begin("workspace")
+            for result in results:
+                logger.log(result)
+            if name != "term":  # TermLogger.end() exits when something failed.
+                logger.end()
+        timings[name] = time.perf_counter() - time_start
+    return timings
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_history(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report(record: dict, previous: dict) -> None:
+    print(f"revision {record['revision']}, jobs {record['jobs']}, python {record['python']}")
+    for mode, scenario in record["scenarios"].items():
+        line = (
+            f"{mode:<8} {scenario['cases_per_second']:8.2f} cases/s  ({scenario['passed']}/{scenario['cases']} passed)"
+        )
+        if previous is not None and mode in previous["scenarios"]:
+            before = previous["scenarios"][mode]["cases_per_second"]
+            line += f"  {(scenario['cases_per_second'] / before - 1) * 100:+.1f}% vs {previous['revision']}"
+        print(line)
+        for name, phase in scenario["phases"].items():
+            print(
+                f"    {name:<9} {phase['wall_time']:8.3f}s  children cpu {phase['children_cpu']:7.3f}s"
+                f"  max rss {phase['max_rss'] / 1024:7.1f} MiB"
+            )
+    print("loggers  " + "  ".join(f"{name} {seconds:.3f}s" for name, seconds in record["loggers"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmarks of the Docman judge")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, help="number of concurrent cases")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--api_latency", type=float, default=0.01, help="seconds the stand-in API takes per request")
+    parser.add_argument("--history", default="bench_results.jsonl", help="where results of every run are kept")
+    args = parser.parse_args()
+
+    with StubApi(latency=args.api_latency) as api, TemporaryDirectory() as tmpdir:
+        scenarios = {}
+        for mode in args.scenarios:
+            print(f"Benchmarking {mode} ({SCENARIOS[mode]})...", flush=True)
+            workdir = Path(tmpdir) / mode
+            workdir.mkdir()
+            scenarios[mode] = bench_scenario(mode, workdir, api.endpoint, args.jobs)
+        loggers = bench_loggers(Path(tmpdir))
+
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "jobs": args.jobs,
+        "scenarios": scenarios,
+        "loggers": loggers,
+    }
+    history = load_history(args.history)
+    previous = next((old for old in reversed(history) if old["jobs"] == record["jobs"]), None)
+    report(record, previous)
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
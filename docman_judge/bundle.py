@@ -0,0 +1,202 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+from docman_judge.cases import Case, MalformedCase
+from docman_judge.lookup import default_cache_path
+
+# A case bundle packs a whole case set in one file: every input and citation file, the expected outputs
+# and an index of the cases. It is built once (`docman-judge bundle`), then memory-mapped by each run, which
+# only writes out the files a case actually hands to the program, the first time the case needs them.
+#
+# Layout: MAGIC, the offset of the index as a little-endian uint64, the file and answer contents
+# (identical contents stored once), then the index as JSON:
+#
+#     {"version": 1, "files": {"inputs/1.txt": [offset, length], ...}, "cases": [...]}
+#
+# A case expects either an answer stored in the bundle ("expect") or one of its files ("expect_file").
+
+MAGIC = b"DJBUNDLE"
+HEADER = struct.Struct("<8sQ")
+VERSION = 1
+
+
+class BundleError(Exception):
+    pass
+
+
+def default_bundle_cache_dir() -> Path:
+    return default_cache_path().parent / "cases"
+
+
+class BundleWriter:
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self.tmp_path = Path(f"{path}.{os.getpid()}.tmp")  # Judges may write the same cached bundle at once.
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(HEADER.pack(MAGIC, 0))
+        self.blobs: Dict[str, Tuple[int, int]] = {}
+
+    def add(self, data: bytes) -> Tuple[int, int]:
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.blobs:
+            self.blobs[digest] = (self.file.tell(), len(data))
+            self.file.write(data)
+        return self.blobs[digest]
+
+    # Like add(), for a file of any size: it is hashed, then copied into the bundle if it is new, a chunk at a time.
+    def add_file(self, path: Path) -> Tuple[int, int]:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+            if digest.hexdigest() not in self.blobs:
+                f.seek(0)
+                offset = self.file.tell()
+                shutil.copyfileobj(f, self.file, 1 << 20)
+                self.blobs[digest.hexdigest()] = (offset, self.file.tell() - offset)
+        return self.blobs[digest.hexdigest()]
+
+    def close(self, index: dict) -> None:
+        index_offset = self.file.tell()
+        self.file.write(json.dumps(index).encode())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, index_offset))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+# Packs `cases` and every file under `root` they may refer to. Paths of the cases must lie under `root`.
+def pack_bundle(path: Union[str, Path], root: Path, cases: List[Union[Case, MalformedCase]]) -> None:
+    writer = BundleWriter(path)
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            file_path = Path(dirpath) / filename
+            files[file_path.relative_to(root).as_posix()] = writer.add_file(file_path)
+
+    def key(file_path: Union[str, Path]) -> str:
+        return Path(file_path).relative_to(root).as_posix()
+
+    packed_cases = []
+    for case in cases:
+        if isinstance(case, MalformedCase):
+            # Arguments naming a file of the bundle are marked, the others are passed as they are.
+            args = [
+                {"file": key(arg)} if isinstance(arg, Path) or str(arg).startswith(str(root)) else str(arg)
+                for arg in case.args
+            ]
+            packed_cases.append({"name": case.name, "args": args})
+        else:
+            expect = None if case.expect_output is None else writer.add(case.expect_output.encode("utf-8"))
+            packed_cases.append(
+                {
+                    "name": case.name,
+                    "input": key(case.input_doc_path),
+                    "redirect": case.need_redirect,
+                    "citation": key(case.input_citation),
+                    "output": case.output,
+                    "expect": expect,
+                    "error": case.error,
+                    "expect_file": None if case.expect_path is None else key(case.expect_path),
+                }
+            )
+    writer.close({"version": VERSION, "files": files, "cases": packed_cases})
+
+
+_mapped: Dict[Tuple[int, str], mmap.mmap] = {}
+_mapped_lock = threading.Lock()
+
+
+# The bundle at `path` mapped into memory, once per process.
+def map_bundle(path: str) -> mmap.mmap:
+    with _mapped_lock:
+        if (os.getpid(), path) not in _mapped:
+            with open(path, "rb") as f:
+                _mapped[(os.getpid(), path)] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return _mapped[(os.getpid(), path)]
+
+
+# A path of a bundled file, written out under the working directory of the bundle on first use. It can be
+# passed wherever a path is expected (open(), os.path, subprocess arguments), and to other processes.
+class BundleFile(os.PathLike):
+    def __init__(self, bundle_path: str, target: str, offset: int, length: int) -> None:
+        self.bundle_path = bundle_path
+        self.target = target
+        self.offset = offset
+        self.length = length
+
+    def materialize(self) -> str:
+        if not os.path.exists(self.target):
+            os.makedirs(os.path.dirname(self.target), exist_ok=True)
+            data = memoryview(map_bundle(self.bundle_path))[self.offset : self.offset + self.length]
+            # Written aside and renamed, so concurrent cases never see a partial file.
+            tmp_path = f"{self.target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.target)
+        return self.target
+
+    def __fspath__(self) -> str:
+        return self.materialize()
+
+    def __str__(self) -> str:
+        return self.materialize()
+
+    def __repr__(self) -> str:
+        return f"BundleFile({self.target!r})"
+
+
+class CaseBundle:
+    def __init__(self, path: Union[str, Path], workdir: Union[str, Path]) -> None:
+        self.path = os.path.abspath(path)
+        self.workdir = os.path.abspath(workdir)
+        self.data = map_bundle(self.path)
+        magic, index_offset = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise BundleError(f"{path} is not a case bundle.")
+        self.index = json.loads(self.data[index_offset:])
+        if self.index.get("version") != VERSION:
+            raise BundleError(f"{path} is a version {self.index.get('version')} bundle, expected {VERSION}.")
+
+    # Files missing from the bundle, like the inputs of the cases about missing files, become plain
+    # paths under the working directory which are never created.
+    def file(self, key: str) -> Union[Path, BundleFile]:
+        target = os.path.join(self.workdir, *key.split("/"))
+        if key not in self.index["files"]:
+            return Path(target)
+        offset, length = self.index["files"][key]
+        return BundleFile(self.path, target, offset, length)
+
+    def text(self, blob: Union[None, List[int]]) -> Union[None, str]:
+        if blob is None:
+            return None
+        offset, length = blob
+        return self.data[offset : offset + length].decode("utf-8")
+
+    def cases(self) -> List[Union[Case, MalformedCase]]:
+        cases = []
+        for packed in self.index["cases"]:
+            if "args" in packed:
+                args = [self.file(arg["file"]) if isinstance(arg, dict) else arg for arg in packed["args"]]
+                cases.append(MalformedCase(args, packed["name"]))
+            else:
+                cases.append(
+                    Case(
+                        self.file(packed["input"]),
+                        packed["redirect"],
+                        self.file(packed["citation"]),
+                        packed["output"],
+                        self.text(packed["expect"]),
+                        packed["error"],
+                        packed["name"],
+                        None if packed.get("expect_file") is None else self.file(packed["expect_file"]),
+                    )
+                )
+        return cases
@@ -7,7 +7,8 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Union
 
-from docman_judge.correct import transform_article
+from docman_judge.answers import AnswerStore
+from docman_judge.correct import write_expected_output
 
 
 @dataclass
@@ -18,6 +19,9 @@ class Case:
     output: Union[None, str]
     expect_output: Union[None, str]
     error: bool
+    name: str = ""  # stable across runs, e.g. "10_mut1.txt:stdin-stdout"
+    # The expected output in a file, for articles too large to keep it in memory; expect_output is None then.
+    expect_path: Union[None, Path] = None
 
     def generate_args(self) -> List[str]:
         args = ["-c", self.input_citation]
@@ -39,6 +43,7 @@ class Case:
 @dataclass
 class MalformedCase:
     args: List[str]
+    name: str = ""
 
 
 # 8 random and valid isbn13
@@ -96,29 +101,34 @@ article_lists = [
 ]
 
 
-def get_random_str(size, chars=string.ascii_letters + string.digits + string.punctuation + " \n\t") -> str:
+# Bump when the generated cases change for a given seed, so case sets cached by seed are regenerated.
+GENERATOR_VERSION = 1
+
+
+# All randomness comes from `rng`, so a case set is reproducible from its seed and the module lists stay as they are.
+def get_random_str(
+    rng: random.Random, size, chars=string.ascii_letters + string.digits + string.punctuation + " \n\t"
+) -> str:
     chars = chars.replace("[", "").replace("]", "")  # remove special characters...
-    return "".join(random.choices(chars, k=size))
+    return "".join(rng.choices(chars, k=size))
 
 
-def get_random_json() -> dict:
+def get_random_json(rng: random.Random) -> dict:
     result = {"version": 1, "citations": []}
-    book_num = random.randint(0, len(isbn_lists))
-    website_num = random.randint(0, len(website_lists))
+    book_num = rng.randint(0, len(isbn_lists))
+    website_num = rng.randint(0, len(website_lists))
 
-    random.shuffle(isbn_lists)
-    random.shuffle(website_lists)
-    books = isbn_lists[:book_num]
-    websites = website_lists[:website_num]
+    books = rng.sample(isbn_lists, book_num)
+    websites = rng.sample(website_lists, website_num)
 
     determined_id = "unique_since_too_long"
     # id length is from 1 to 20.
     ids = [
-        get_random_str(random.randint(1, len(determined_id)), string.ascii_letters + string.digits)
+        get_random_str(rng, rng.randint(1, len(determined_id)), string.ascii_letters + string.digits)
         for _ in range(book_num + website_num + 10)  # +10 to prevent non-unique
     ]
 
-    ids = list(set(ids))
+    ids = list(dict.fromkeys(ids))  # Not a set, whose order changes with the hash seed.
     # In case worst things happen... (very unlikely)
     if len(ids) < book_num + website_num:
         num = book_num + website_num - len(ids)
@@ -131,24 +141,25 @@ def get_random_json() -> dict:
     for i in range(website_num):
         result["citations"].append({"id": ids[book_num + i], "type": "webpage", "url": websites[i]})
 
-    result["citations"] += article_lists
+    result["citations"] += deepcopy(article_lists)
 
-    random.shuffle(result["citations"])
+    rng.shuffle(result["citations"])
     return result
 
 
-def generate_random_files(input_dir: Path, citation_dir: Path) -> None:
+def generate_random_files(input_dir: Path, citation_dir: Path, seed: Union[None, int] = None) -> None:
+    rng = random.Random(seed)
     offset = 10  # File name count from 10.
     for i in range(3):
         # Generate 3 correct files
-        final_citation_dict = get_random_json()
+        final_citation_dict = get_random_json(rng)
         citations = final_citation_dict["citations"]
         citation_ids = [citation["id"] for citation in citations]
         final_input = ""
         for citation_id in citation_ids:
-            content = get_random_str(random.randint(50, 100))
+            content = get_random_str(rng, rng.randint(50, 100))
             final_input += content + "[" + citation_id + "]"
-        final_input += get_random_str(random.randint(50, 100))
+        final_input += get_random_str(rng, rng.randint(50, 100))
 
         with (
             open(citation_dir / f"{offset + i}.txt", "w") as citefile,
@@ -161,13 +172,13 @@ def generate_random_files(input_dir: Path, citation_dir: Path) -> None:
         def del_mutate(key, suffix):
             new_dict = deepcopy(final_citation_dict)
             if key is not None:
-                del new_dict["citations"][random.randint(0, len(citation_ids) - 1)][key]
+                del new_dict["citations"][rng.randint(0, len(citation_ids) - 1)][key]
             else:
-                curr_dict = new_dict["citations"][random.randint(0, len(citation_ids) - 1)]
+                curr_dict = new_dict["citations"][rng.randint(0, len(citation_ids) - 1)]
                 keys = list(curr_dict.keys())
                 keys.remove("id")
                 keys.remove("type")  # They're already tested.
-                curr_dict.pop(random.choice(keys))
+                curr_dict.pop(rng.choice(keys))
 
             with (
                 open(citation_dir / f"{offset + i}{suffix}.txt", "w") as citefile,
@@ -183,14 +194,14 @@ def generate_random_files(input_dir: Path, citation_dir: Path) -> None:
         # change type of necessary keys
         def change_mutate(key, suffix):
             new_dict = deepcopy(final_citation_dict)
-            mutpos = new_dict["citations"][random.randint(0, len(citation_ids) - 1)]
+            mutpos = new_dict["citations"][rng.randint(0, len(citation_ids) - 1)]
 
             if key is None:
-                key = random.choice(list(mutpos.keys()))
+                key = rng.choice(list(mutpos.keys()))
             if type(mutpos[key]) is str:
-                mutpos[key] = 1 if random.random() < 0.5 else [1, 2, 3]  # mutate to int or list
+                mutpos[key] = 1 if rng.random() < 0.5 else [1, 2, 3]  # mutate to int or list
             elif type(mutpos[key]) is int:
-                mutpos[key] = "You're fooled" if random.random() < 0.5 else {"You": "Great"}  # mutate to str or dict
+                mutpos[key] = "You're fooled" if rng.random() < 0.5 else {"You": "Great"}  # mutate to str or dict
 
             with (
                 open(citation_dir / f"{offset + i}{suffix}.txt", "w") as citefile,
@@ -205,7 +216,7 @@ def generate_random_files(input_dir: Path, citation_dir: Path) -> None:
         # make some citations absent.
         def citation_wrong_mutate(suffix):
             new_dict = deepcopy(final_citation_dict)
-            del new_dict["citations"][random.randint(0, len(citation_ids) - 1)]
+            del new_dict["citations"][rng.randint(0, len(citation_ids) - 1)]
 
             with (
                 open(citation_dir / f"{offset + i}{suffix}.txt", "w") as citefile,
@@ -219,7 +230,7 @@ def generate_random_files(input_dir: Path, citation_dir: Path) -> None:
         # make bracket unmatched.
         def input_wrong_mutate(suffix):
             new_input = deepcopy(final_input)
-            pos = random.randint(0, len(new_input))
+            pos = rng.randint(0, len(new_input))
             new_input = new_input[:pos] + "[" + new_input[pos:]  # Add unmatched '['
 
             with (
@@ -232,7 +243,107 @@ def generate_random_files(input_dir: Path, citation_dir: Path) -> None:
         input_wrong_mutate("_mut7")
 
 
-def get_cases(input_dir: Path, citation_dir: Path, output_dir: Path) -> List[Union[Case, MalformedCase]]:
+def parse_size(size: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    size = size.strip().upper().removesuffix("B").removesuffix("I")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    for unit, scale in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if size >= scale and size % scale == 0:
+            return f"{size // scale}{unit}"
+    return str(size)
+
+
+# `remote_ratio` of the citations are books and webpages, which need the metadata API, the rest are articles.
+def get_stress_citations(rng: random.Random, num: int, id_length: int, remote_ratio: float = 0.1) -> List[dict]:
+    citations = []
+    for i in range(num):
+        # Long ids sharing a long prefix, to punish slow id comparison and hashing.
+        citation_id = f"{i:x}_".rjust(rng.randint(max(1, id_length // 2), id_length), "r")
+        kind = rng.random()
+        if kind < remote_ratio / 2:
+            citations.append({"id": citation_id, "type": "book", "isbn": rng.choice(isbn_lists)})
+        elif kind < remote_ratio:
+            citations.append({"id": citation_id, "type": "webpage", "url": rng.choice(website_lists)})
+        else:
+            article = dict(rng.choice(article_lists))
+            article["id"] = citation_id
+            article["volume"] = rng.randint(1, 100)
+            citations.append(article)
+    return citations
+
+
+# Writes `{name}.txt` into `input_dir` and `citation_dir`: an article of about `size` bytes citing one of
+# `num_citations` citations every `reference_every` characters on average. The article is written in chunks
+# from a pool of random text, so the generator never holds it in memory.
+def generate_stress_file(
+    input_dir: Path,
+    citation_dir: Path,
+    name: str,
+    size: int,
+    num_citations: int = 2000,
+    reference_every: int = 1000,
+    id_length: int = 64,
+    seed: Union[None, int] = None,
+    remote_ratio: float = 0.1,
+) -> None:
+    rng = random.Random(seed)
+    citations = get_stress_citations(rng, num_citations, id_length, remote_ratio)
+    with open(citation_dir / f"{name}.txt", "w") as citefile:
+        citefile.write('{"version": 1, "citations": [')
+        citefile.write(", ".join(json.dumps(citation) for citation in citations))
+        citefile.write("]}")
+
+    pool = "".join(rng.choices(string.ascii_letters + string.digits + " \n\t.,;:!?-", k=1 << 16))
+    ids = [citation["id"] for citation in citations]
+    written = 0
+    with open(input_dir / f"{name}.txt", "w", encoding="utf-8", newline="") as inputfile:
+        while written < size:
+            chunk = []
+            for _ in range(64):
+                length = rng.randint(1, 2 * reference_every)
+                start = rng.randrange(len(pool) - length) if length < len(pool) else 0
+                chunk.append(pool[start : start + length])
+                chunk.append(f"[{rng.choice(ids)}]")
+            chunk = "".join(chunk)[: size - written]
+            if chunk.rfind("[") > chunk.rfind("]"):  # Don't cut a reference in half.
+                chunk = chunk[: chunk.rfind("[")]
+            inputfile.write(chunk)
+            written += len(chunk)
+
+
+# An article with `depth` nested brackets, which any implementation has to reject without overflowing its stack.
+def generate_nested_file(input_dir: Path, citation_dir: Path, name: str, depth: int) -> None:
+    with open(citation_dir / f"{name}.txt", "w") as citefile:
+        json.dump({"version": 1, "citations": article_lists}, citefile)
+    with open(input_dir / f"{name}.txt", "w") as inputfile:
+        inputfile.write("[" * depth + article_lists[0]["id"] + "]" * depth)
+
+
+def generate_performance_files(
+    input_dir: Path,
+    citation_dir: Path,
+    sizes: List[int],
+    num_citations: int = 2000,
+    nesting: int = 100000,
+    seed: Union[None, int] = None,
+) -> None:
+    for size in sizes:
+        generate_stress_file(input_dir, citation_dir, f"perf_{format_size(size)}", size, num_citations, seed=seed)
+    if nesting > 0:
+        generate_nested_file(input_dir, citation_dir, f"perf_nested_{nesting}", nesting)
+
+
+# `Case.output` is a bare file name: the judge resolves it inside the scratch directory of each case run.
+def get_cases(
+    input_dir: Path, citation_dir: Path, answers: Union[None, AnswerStore] = None
+) -> List[Union[Case, MalformedCase]]:
+    if answers is None:
+        answers = AnswerStore()
     cases = []
 
     for filename in os.listdir(input_dir):
@@ -244,18 +355,18 @@ def get_cases(input_dir: Path, citation_dir: Path, output_dir: Path) -> List[Uni
 
         with open(input_path, "r") as file:
             input_str = file.read()
-        output_path = output_dir / f"answer{filename}"
-        expect_output = transform_article(input_str, citation_path)
+        output_path = f"answer{filename}"
+        expect_output = answers.get(input_str, citation_path)
         expect_output, error = expect_output.result, not expect_output.success
 
         # -c citation_path -o output_path input_file
-        cases.append(Case(input_path, False, citation_path, output_path, expect_output, error))
+        cases.append(Case(input_path, False, citation_path, output_path, expect_output, error, f"{filename}:file-file"))
         # -c citation_path input_file
-        cases.append(Case(input_path, False, citation_path, None, expect_output, error))
+        cases.append(Case(input_path, False, citation_path, None, expect_output, error, f"{filename}:file-stdout"))
         # -c citation_path -o output_path -
-        cases.append(Case(input_path, True, citation_path, output_path, expect_output, error))
+        cases.append(Case(input_path, True, citation_path, output_path, expect_output, error, f"{filename}:stdin-file"))
         # -c citation_path -
-        cases.append(Case(input_path, True, citation_path, None, expect_output, error))
+        cases.append(Case(input_path, True, citation_path, None, expect_output, error, f"{filename}:stdin-stdout"))
 
     valid_input, valid_citation = (
         input_dir / "1.txt",
@@ -269,40 +380,61 @@ def get_cases(input_dir: Path, citation_dir: Path, output_dir: Path) -> List[Uni
     # Input paths not exist:
     cases.extend(
         [
-            Case(invalid_input, False, valid_citation, None, None, True),
-            Case(invalid_input, False, valid_citation, "non-exist.txt", None, True),
+            Case(invalid_input, False, valid_citation, None, None, True, "missing-input:file-stdout"),
+            Case(invalid_input, False, valid_citation, "non-exist.txt", None, True, "missing-input:file-file"),
         ]
     )
 
     # Citation paths not exist:
     cases.extend(
         [
-            Case(valid_input, False, invalid_citation, None, None, True),
-            Case(valid_input, False, invalid_citation, "non-exist.txt", None, True),
+            Case(valid_input, False, invalid_citation, None, None, True, "missing-citation:file-stdout"),
+            Case(valid_input, False, invalid_citation, "non-exist.txt", None, True, "missing-citation:file-file"),
         ]
     )
 
     # Both paths not exist
     cases.extend(
         [
-            Case(invalid_input, False, invalid_citation, None, None, True),
-            Case(invalid_input, False, invalid_citation, "non-exist.txt", None, True),
+            Case(invalid_input, False, invalid_citation, None, None, True, "missing-both:file-stdout"),
+            Case(invalid_input, False, invalid_citation, "non-exist.txt", None, True, "missing-both:file-file"),
         ]
     )
 
     # Then malformed ones...
-    cases.extend(
-        [
-            MalformedCase([]),
-            MalformedCase(["stray"]),
-            MalformedCase(["more", "stray"]),
-            MalformedCase(["--unrecognized"]),
-            MalformedCase(["--dramatic", "unrecognized"]),
-            MalformedCase(["-o"]),
-            MalformedCase(["-c"]),
-            MalformedCase(["-o", "a.txt", "-o", "b.txt", valid_input]),
-            MalformedCase(["-c", valid_citation, "-c", valid_citation, valid_input]),
-        ]
-    )
+    malformed_cases = [
+        MalformedCase([]),
+        MalformedCase(["stray"]),
+        MalformedCase(["more", "stray"]),
+        MalformedCase(["--unrecognized"]),
+        MalformedCase(["--dramatic", "unrecognized"]),
+        MalformedCase(["-o"]),
+        MalformedCase(["-c"]),
+        MalformedCase(["-o", "a.txt", "-o", "b.txt", valid_input]),
+        MalformedCase(["-c", valid_citation, "-c", valid_citation, valid_input]),
+    ]
+    for i, case in enumerate(malformed_cases):
+        case.name = f"malformed:{i}"
+    cases.extend(malformed_cases)
 
     return cases
+
+
+# The performance tier: every generated file is run once through the file and once through stdin,
+# the answer going to stdout where it is checked as the program prints it. The articles are large, so their
+# expected outputs are streamed to `expected_dir` rather than held in memory.
+def get_performance_cases(input_dir: Path, citation_dir: Path, expected_dir: Path) -> List[Case]:
+    cases = []
+    for filename in sorted(os.listdir(input_dir)):
+        input_path, citation_path, expected_path = (
+            input_dir / filename,
+            citation_dir / filename,
+            expected_dir / filename,
+        )
+        success = write_expected_output(input_path, citation_path, expected_path)
+        expect_path = expected_path if success else None
+        for redirect, mode in ((False, "file-stdout"), (True, "stdin-stdout")):
+            cases.append(
+                Case(input_path, redirect, citation_path, None, None, not success, f"{filename}:{mode}", expect_path)
+            )
+    return cases
@@ -0,0 +1,308 @@
+import argparse
+import collections
+import ipaddress
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import replace
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Deque, Dict, List, Tuple, Union
+
+from docman_judge.bundle import CaseBundle
+from docman_judge.judge import JudgeResult
+from docman_judge.log import ILogger
+
+if TYPE_CHECKING:
+    from docman_judge.main import JudgeOptions
+
+# Judging spread over machines: a coordinator holds the queue of workspaces and the case set (as a case
+# bundle, answers included); workers connect, download the case set once, then pull workspaces one at a time
+# and stream their results back. A workspace whose worker fails or goes silent is queued again.
+#
+#     export DOCMAN_JUDGE_AUTHKEY=$(openssl rand -hex 16)   # the same secret on every machine
+#     docman-judge --serve 0.0.0.0:7878 --batch workspaces.txt --log log.jsonl --log_format jsonl
+#     docman-judge worker coordinator-host:7878 -j 8        # on every worker machine
+#
+# Workspace paths must be valid on the workers too, e.g. on a shared file system. Messages are pickled, so
+# whoever knows the secret can run code on the coordinator and the workers: it is required unless the
+# coordinator only listens on the loopback interface.
+
+DEFAULT_AUTHKEY = os.environ.get("DOCMAN_JUDGE_AUTHKEY")
+LOOPBACK_AUTHKEY = "docman-judge"
+HEARTBEAT_INTERVAL = 30
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:  # a host name
+        return host == "localhost"
+
+
+# The secret to listen on or connect to `address` with: `authkey`, or a well-known one on the loopback interface.
+def resolve_authkey(address: Tuple[str, int], authkey: Union[None, str]) -> str:
+    if authkey:
+        return authkey
+    if not is_loopback(address[0]):
+        raise ValueError(
+            f"{address[0]} is not a loopback address: pass a secret --authkey or set $DOCMAN_JUDGE_AUTHKEY"
+        )
+    return LOOPBACK_AUTHKEY
+
+
+# Sends what judge() logs to the coordinator, while a thread tells it the worker is alive during long builds.
+class ConnectionLogger(ILogger):
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message: tuple) -> None:
+        with self.lock:
+            self.conn.send(message)
+
+    def begin(self, ws_path: str) -> None:
+        self.send(("begin", ws_path))
+
+    def log(self, result: JudgeResult) -> bool:
+        self.send(("result", result))
+        return result.success
+
+    def end(self) -> None:
+        self.send(("end",))
+
+    def heartbeat(self, stop: threading.Event) -> None:
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.send(("alive",))
+            except OSError:
+                return
+
+
+class Coordinator:
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        authkey: str,
+        workspaces: List[str],
+        bundle_path: Union[str, Path],
+        options: "JudgeOptions",
+        max_attempts: int = 3,
+        worker_timeout: float = 600,
+    ) -> None:
+        self.listener = Listener(address, authkey=authkey.encode())
+        with open(bundle_path, "rb") as f:
+            self.bundle = f.read()
+        self.options = options
+        self.max_attempts = max_attempts
+        self.worker_timeout = worker_timeout
+        self.pending: Deque[str] = collections.deque(os.path.abspath(path) for path in workspaces)
+        self.attempts: Dict[str, int] = collections.Counter()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.handlers: List[threading.Thread] = []
+        # (workspace, results, worker) of every workspace done, handed to the logger by the main thread.
+        self.finished: "queue.Queue[Tuple[str, List[JudgeResult], str]]" = queue.Queue()
+
+    @property
+    def address(self) -> str:
+        host, port = self.listener.address
+        return f"{host}:{port}"
+
+    # The next workspace to judge, None once every workspace is judged or given up on.
+    def take(self) -> Union[None, str]:
+        with self.condition:
+            while len(self.pending) == 0 and self.in_flight > 0:
+                self.condition.wait()
+            if len(self.pending) == 0:
+                return None
+            self.in_flight += 1
+            return self.pending.popleft()
+
+    def complete(self, path: str, results: List[JudgeResult], worker: str) -> None:
+        self.finished.put((path, results, worker))
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def retry(self, path: str, reason: str, worker: str) -> None:
+        with self.condition:
+            self.attempts[path] += 1
+            if self.attempts[path] < self.max_attempts:
+                print(f"Requeuing {path}: {reason} ({worker})", flush=True)
+                self.pending.append(path)
+                self.in_flight -= 1
+                self.condition.notify_all()
+                return
+        message = f"Gave up after {self.attempts[path]} attempts, the last one: {reason} ({worker})"
+        self.complete(path, [JudgeResult("judge", False, message, outcome="judge-error")], worker)
+
+    # Judges none of the workspaces left, e.g. once no worker is left to judge them.
+    def abandon(self, reason: str) -> None:
+        with self.condition:
+            paths, self.pending = list(self.pending), collections.deque()
+            self.in_flight += len(paths)
+        for path in paths:
+            self.complete(path, [JudgeResult("judge", False, reason, outcome="judge-error")], "coordinator")
+
+    # Whether the workers this coordinator started have all exited, without another worker connected.
+    def workers_gone(self, workers: List[subprocess.Popen]) -> bool:
+        return all(worker.poll() is not None for worker in workers) and not any(
+            handler.is_alive() for handler in self.handlers
+        )
+
+    def receive(self, conn: Connection) -> tuple:
+        if not conn.poll(self.worker_timeout):
+            raise TimeoutError(f"no word from the worker in {self.worker_timeout}s")
+        return conn.recv()
+
+    def handle(self, conn: Connection) -> None:
+        worker, current, results = "unknown worker", None, []
+        try:
+            worker = self.receive(conn)[1]
+            conn.send(("cases", self.bundle, self.options))
+            while True:
+                message = self.receive(conn)
+                if message[0] == "next":
+                    current, results = self.take(), []
+                    conn.send(("done",) if current is None else ("workspace", current))
+                    if current is None:
+                        return
+                elif message[0] == "result":
+                    results.append(message[1])
+                elif message[0] == "end":
+                    self.complete(current, results, worker)
+                    current = None
+                elif message[0] == "failed":
+                    self.retry(current, message[1], worker)
+                    current = None
+        except Exception as e:  # lost connection, silence, or a message that doesn't unpickle
+            if current is not None:
+                self.retry(current, f"worker lost: {str(e) or type(e).__name__}", worker)
+        finally:
+            conn.close()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:  # closed once everything is judged
+                return
+            handler = threading.Thread(target=self.handle, args=(conn,), daemon=True)
+            handler.start()
+            self.handlers.append(handler)
+
+    # With `workers`, the local workers started for this run: once they have all exited with workspaces left,
+    # those are failed rather than waited for.
+    def run(self, logger: ILogger, workers: List[subprocess.Popen] = ()) -> None:
+        print(f"Coordinating on {self.address}", flush=True)
+        threading.Thread(target=self.accept, daemon=True).start()
+        total = len(self.pending)
+        try:
+            for i in range(total):
+                while True:
+                    try:
+                        path, results, worker = self.finished.get(timeout=1)
+                        break
+                    except queue.Empty:
+                        if len(workers) > 0 and self.workers_gone(workers):
+                            codes = ", ".join(str(worker.returncode) for worker in workers)
+                            reason = f"No worker left: the local workers exited with codes {codes}."
+                            print(reason, flush=True)
+                            self.abandon(reason)
+                logger.begin(os.path.abspath(path))
+                for result in results:
+                    logger.log(result)
+                logger.end()
+                print(f"Judged {i + 1}/{total}: {path} ({worker})", flush=True)
+        finally:
+            self.listener.close()
+        # Let idle workers hear that everything is done before this process exits.
+        for handler in list(self.handlers):
+            handler.join(timeout=1)
+
+
+def connect(address: Tuple[str, int], authkey: str, timeout: float) -> Connection:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey.encode())
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+def run_worker(address: Tuple[str, int], authkey: str, jobs: Union[None, int] = None, timeout: float = 30) -> int:
+    from docman_judge.main import judge  # main imports this module for its commands
+
+    conn = connect(address, authkey, timeout)
+    logger = ConnectionLogger(conn)
+    stop = threading.Event()
+    judged = 0
+    with TemporaryDirectory() as tmpdir:
+        try:
+            conn.send(("hello", f"{socket.gethostname()}:{os.getpid()}"))
+            _, bundle, options = conn.recv()
+            bundle_path = Path(tmpdir) / "cases.bundle"
+            bundle_path.write_bytes(bundle)
+            cases = CaseBundle(bundle_path, Path(tmpdir) / "bundle").cases()
+            options = replace(options, verbose=False, jobs=options.jobs if jobs is None else jobs)
+            threading.Thread(target=logger.heartbeat, args=(stop,), daemon=True).start()
+            while True:
+                try:
+                    logger.send(("next",))
+                    message = conn.recv()
+                except (EOFError, ConnectionError):  # the coordinator is gone, its work done or handed out again
+                    break
+                if message[0] == "done":
+                    break
+                try:
+                    judge(message[1], cases, logger, options)
+                except Exception as e:
+                    logger.send(("failed", f"{type(e).__name__}: {e}"))
+                judged += 1
+        finally:
+            stop.set()
+            conn.close()
+    return judged
+
+
+# Starts `count` workers on this machine, e.g. to try a coordinator out.
+def spawn_workers(address: str, authkey: str, count: int, jobs: Union[None, int] = None) -> List[subprocess.Popen]:
+    command = [sys.executable, "-m", "docman_judge.main", "worker", address]
+    if jobs is not None:
+        command += ["--jobs", str(jobs)]
+    env = dict(os.environ, DOCMAN_JUDGE_AUTHKEY=authkey)
+    return [subprocess.Popen(command, env=env) for _ in range(count)]
+
+
+# `docman-judge worker HOST:PORT`
+def worker_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="docman-judge worker", description="Judge workspaces for a coordinator")
+    parser.add_argument("address", help="HOST:PORT the coordinator listens on")
+    parser.add_argument(
+        "--authkey",
+        default=DEFAULT_AUTHKEY,
+        help="shared secret, $DOCMAN_JUDGE_AUTHKEY by default; required unless the coordinator is on loopback",
+    )
+    parser.add_argument("--jobs", "-j", type=int, help="number of test cases run concurrently, as the coordinator's")
+    parser.add_argument("--connect_timeout", type=float, default=30, help="seconds to wait for the coordinator")
+    args = parser.parse_args(argv)
+    address = parse_address(args.address)
+    try:
+        authkey = resolve_authkey(address, args.authkey)
+    except ValueError as e:
+        parser.error(str(e))
+    judged = run_worker(address, authkey, args.jobs, args.connect_timeout)
+    print(f"Worker done, judged {judged} workspaces")
@@ -1,11 +1,12 @@
+import collections
 import json
+import os
 import re
-import urllib
-import urllib.parse
 from dataclasses import dataclass
-from typing import Dict, Tuple, Union
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
-import requests
+from docman_judge.lookup import lookup
 
 
 @dataclass
@@ -74,19 +75,9 @@ def check_citation(citation_path: str) -> Tuple[Dict[str, dict], bool]:
 
 
 def citation_info_to_str(citation) -> Union[None, str]:
-    API_ENDPOINT = "http://docman.zhuof.wang"
-
     if citation["type"] == "book":
-        result = requests.get(
-            API_ENDPOINT + "/isbn/" + urllib.parse.quote(citation["isbn"], safe="")
-        )
-        result = json.loads(result.content.decode())
-        if (
-            "author" not in result
-            or "title" not in result
-            or "publisher" not in result
-            or "year" not in result
-        ):
+        result = lookup("isbn", citation["isbn"])
+        if "author" not in result or "title" not in result or "publisher" not in result or "year" not in result:
             return None
         if (
             type(result["author"]) is not str
@@ -104,10 +95,7 @@ def citation_info_to_str(citation) -> Union[None, str]:
             result["year"],
         )
     elif citation["type"] == "webpage":
-        result = requests.get(
-            API_ENDPOINT + "/title/" + urllib.parse.quote(citation["url"], safe="")
-        )
-        result = json.loads(result.content.decode())
+        result = lookup("title", citation["url"])
         if "title" not in result or type(result["title"]) is not str:
             return None
         return "[%s] webpage: %s. Available at %s" % (
@@ -127,29 +115,114 @@ def citation_info_to_str(citation) -> Union[None, str]:
         )
 
 
-def transform_article(article: str, citation_path: str):
-    ref_pairs, success = check_bracket_match(article)
+# Whether the brackets of the article match, in the constant memory of a depth counter.
+def brackets_match(chunks: Iterable[str]) -> bool:
+    depth = 0
+    for chunk in chunks:
+        for match in re.finditer(r"\[|\]", chunk):
+            depth += 1 if match.group(0) == "[" else -1
+            if depth < 0:  # Too many ']'
+                return False
+    return depth == 0  # Too many '[' otherwise
+
+
+# The reference list of an article, as (entry, times cited) sorted by id, from one pass over the article in
+# `chunks`; None if the article is invalid. Apart from the citation table, memory stays bounded: an id can't be
+# longer than the longest citation id, so a '[' left open longer than that fails the article at once, whether
+# it is closed later (unknown id) or not (unmatched bracket). The verdicts are those of checking the brackets,
+# then the ids.
+def scan_article(chunks: Iterable[str], citation_path: Union[str, Path]) -> Union[None, List[Tuple[str, int]]]:
+    chunks = iter(chunks)
+    try:
+        citations, success = check_citation(citation_path)
+    except Exception:  # e.g. not JSON: an article with unmatched brackets fails before its citations are read
+        if not brackets_match(chunks):
+            return None
+        raise
     if not success:
-        return Answer(None, False)
+        return None
+
+    longest_id = max((len(citation_id) for citation_id in citations), default=0)
+    pending = ""  # the text since the outermost '[' still open
+    opened: List[int] = []  # where each '[' still open is in `pending`
+    used: Dict[str, int] = collections.Counter()
+    for chunk in chunks:
+        position = 0
+        for match in re.finditer(r"\[|\]", chunk):
+            if len(opened) > 0:
+                pending += chunk[position : match.start(0)]
+            position = match.end(0)
+            if match.group(0) == "[":
+                opened.append(len(pending))
+                pending += "["
+            else:
+                if len(opened) == 0:  # Too many ']'
+                    return None
+                curr_id = pending[opened.pop() + 1 :]
+                if curr_id not in citations:  # id not exist
+                    return None
+                used[curr_id] += 1
+                pending = pending + "]" if len(opened) > 0 else ""
+            if len(pending) - 1 > longest_id:
+                return None
+        if len(opened) > 0:
+            pending += chunk[position:]
+            if len(pending) - 1 > longest_id:
+                return None
+    if len(opened) != 0:  # Too many '['
+        return None
+
+    references = []
+    for curr_id in sorted(used):
+        result = citation_info_to_str(citations[curr_id])
+        if result is None:
+            return None
+        references.append((result, used[curr_id]))  # cited twice, listed twice
+    return references
 
-    citations, success = check_citation(citation_path)
-    if not success:
-        return Answer(None, False)
 
-    exist_citations = []
-    for begin, end in ref_pairs:
-        curr_id = article[begin + 1 : end]
-        if curr_id not in citations:  # id not exist
-            return Answer(None, False)
-        exist_citations.append(citations[curr_id])
-
-    exist_citations.sort(key=lambda x: x["id"])
-    reference_list_str = []
-    for citation in exist_citations:
-        result = citation_info_to_str(citation)
-        if result is None:
-            return Answer(None, False)
-        reference_list_str.append(result)
+def reference_lines(references: List[Tuple[str, int]]) -> Iterator[str]:
+    for entry, count in references:
+        for _ in range(count):
+            yield entry
+
 
-    result = article + "\n\nReferences:\n" + "\n".join(reference_list_str)
-    return Answer(result, True)
+def transform_article(article: str, citation_path: str):
+    references = scan_article([article], citation_path)
+    if references is None:
+        return Answer(None, False)
+    return Answer(article + "\n\nReferences:\n" + "\n".join(reference_lines(references)), True)
+
+
+def read_chunks(file, size: int) -> Iterator[str]:
+    while chunk := file.read(size):
+        yield chunk
+
+
+# Streams the expected output of the article at `input_path` to `output_path`: the article is copied as it
+# is scanned, then its reference list is written line by line. For articles too large to solve in memory;
+# the file is only left behind if the article is valid.
+def write_expected_output(
+    input_path: Union[str, Path],
+    citation_path: Union[str, Path],
+    output_path: Union[str, Path],
+    chunk_size: int = 1 << 20,
+) -> bool:
+    with (
+        open(input_path, "r", encoding="utf-8") as article,
+        open(output_path, "w", encoding="utf-8", newline="") as output,
+    ):
+
+        def copied_chunks() -> Iterator[str]:
+            for chunk in read_chunks(article, chunk_size):
+                output.write(chunk)
+                yield chunk
+
+        references = scan_article(copied_chunks(), citation_path)
+        if references is not None:
+            output.write("\n\nReferences:\n")
+            for i, line in enumerate(reference_lines(references)):
+                output.write(line if i == 0 else "\n" + line)
+    if references is None:
+        os.remove(output_path)
+    return references is not None
@@ -0,0 +1,167 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from tempfile import TemporaryDirectory
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+
+from docman_judge.cases import Case, MalformedCase
+from docman_judge.judge import (
+    HeadAndTail,
+    JudgeResult,
+    MeasuredPopen,
+    MonitoredOutput,
+    OutputMonitor,
+    ResourceLimits,
+    RunOptions,
+    case_command,
+    check_run,
+    get_usage,
+    prepare_test,
+    run_result,
+    spawn_exe,
+)
+from docman_judge.profiling import span
+
+# The asyncio engine (--engine asyncio) runs the cases of a workspace on one event loop instead of a thread
+# per case plus two pipe readers each: the loop drains the pipes, a timeout cancels the wait for the program,
+# and a semaphore bounds how many cases run at once. run_exe_async() and test_async() return exactly what
+# run_exe() and test() do.
+#
+# The program is started by MeasuredPopen rather than asyncio.create_subprocess_exec(), whose child watcher
+# reaps it with waitpid() and would lose the resource usage of the case; on Linux its exit is awaited on a
+# pidfd, elsewhere in a thread of the loop's executor.
+
+
+async def wait_exit(proc: MeasuredPopen) -> int:
+    loop = asyncio.get_running_loop()
+    if not hasattr(os, "pidfd_open"):
+        return await loop.run_in_executor(None, proc.wait)
+    pidfd = os.pidfd_open(proc.pid)
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return proc.wait()  # reaps it with wait4()
+
+
+async def drain(
+    pipe, chunks: Union[List[bytes], HeadAndTail], monitor: OutputMonitor, compare: bool, proc: MeasuredPopen
+) -> None:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1 << 16)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        while chunk := await reader.read(1 << 16):
+            chunks.append(chunk)
+            if not monitor.feed(chunk, compare):
+                proc.kill()
+                break
+    finally:
+        transport.close()
+
+
+async def run_exe_async(
+    path: str,
+    args: List[str],
+    rediect_input: Union[None, str],
+    cwd: str,
+    time_limit: float = 60,
+    expect_output: Union[None, str, os.PathLike] = None,
+    output_limit: Union[None, int] = None,
+    limits: Union[None, ResourceLimits] = None,
+) -> Tuple[Union[str, MonitoredOutput], int, str, bool, Dict[str, float], Union[None, str]]:
+    args = [path] + args
+    with span("run_exe", "run", args=" ".join(str(arg) for arg in args)):
+        time_start = time.perf_counter()
+        proc = spawn_exe(args, rediect_input, cwd, limits)
+        monitor = OutputMonitor(expect_output, output_limit)
+        stdout_chunks = [] if expect_output is None else HeadAndTail()
+        stderr_chunks = []
+        readers = asyncio.gather(
+            drain(proc.stdout, stdout_chunks, monitor, True, proc),
+            drain(proc.stderr, stderr_chunks, monitor, False, proc),
+        )
+        timeout = False
+        try:
+            await asyncio.wait_for(wait_exit(proc), time_limit)
+        except asyncio.TimeoutError:
+            timeout = True
+            proc.kill()
+            await wait_exit(proc)
+        except asyncio.CancelledError:  # the workspace was aborted
+            proc.kill()
+            await asyncio.shield(wait_exit(proc))
+            readers.cancel()
+            monitor.close()
+            raise
+        usage = get_usage(proc, time.perf_counter() - time_start)
+        await readers
+        monitor.finish()
+        monitor.close()
+        return run_result(args, proc.returncode, stdout_chunks, stderr_chunks, timeout, usage, monitor, limits)
+
+
+async def test_async(
+    path: str,
+    case: Union[Case, MalformedCase],
+    options: Union[None, RunOptions] = None,
+    deadline: Union[None, float] = None,
+) -> JudgeResult:
+    if options is None:
+        options = RunOptions()
+    exe_path, time_limit, refused = prepare_test(path, case, options, deadline)
+    if refused is not None:
+        return refused
+    with span("test", "run", case=case.name), TemporaryDirectory(prefix="docman-case-") as scratch:
+        args, redirect_input, expect_output = case_command(case)
+        run = await run_exe_async(
+            exe_path,
+            args,
+            redirect_input,
+            scratch,
+            time_limit,
+            expect_output,
+            options.output_limit_for(case),
+            options.limits,
+        )
+        # Comparing a large output would hold up the pipes of the other cases.
+        return await asyncio.to_thread(check_run, case, scratch, run, options.diff_context)
+
+
+# Runs coroutine functions on an event loop of its own, `max_workers` at a time. Like a ThreadPoolExecutor,
+# submit() returns a concurrent.futures.Future; cancelling it also stops a case already running.
+class AsyncExecutor:
+    def __init__(self, max_workers: int) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def limited(self, func: Callable[..., Awaitable], args: tuple):
+        async with self.semaphore:
+            return await func(*args)
+
+    def submit(self, func: Callable[..., Awaitable], *args) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(self.limited(func, args), self.loop)
+
+    async def settle(self) -> None:
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Waits for every case, cancelled ones included, to be done with its program before closing the loop.
+    def shutdown(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.settle(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self) -> "AsyncExecutor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
@@ -0,0 +1,74 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Union
+
+from docman_judge.cases import Case, MalformedCase
+
+# Seconds a case is assumed to take when no run of it is on record, plus its input read at this many bytes/s.
+DEFAULT_COST = 0.05
+DEFAULT_SPEED = 10 << 20
+
+
+@dataclass
+class CaseStats:
+    runs: int = 0
+    failures: int = 0
+    wall_time: float = 0  # total over the runs that measured it
+    timed_runs: int = 0
+
+    def add(self, success: bool, wall_time: Union[None, float]) -> None:
+        self.runs += 1
+        self.failures += not success
+        if wall_time is not None:
+            self.wall_time += wall_time
+            self.timed_runs += 1
+
+
+# Past results of every case, per workspace and over all workspaces, read from JSON Lines logs. Used to run
+# first the cases most likely to fail for the time they take, so a failure shows up as early as possible.
+class CaseHistory:
+    def __init__(self) -> None:
+        self.workspaces: Dict[str, Dict[str, CaseStats]] = {}
+        self.overall: Dict[str, CaseStats] = {}
+
+    @classmethod
+    def from_jsonl(cls, jsonl_path: str) -> "CaseHistory":
+        history = cls()
+        if not os.path.exists(jsonl_path):
+            return history
+        with open(jsonl_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # cut short by a crash
+                    continue
+                if record.get("case") is None or record.get("outcome") == "skipped":
+                    continue
+                wall_time = (record.get("usage") or {}).get("wall_time")
+                own = history.workspaces.setdefault(record["workspace"], {})
+                own.setdefault(record["case"], CaseStats()).add(record["success"], wall_time)
+                history.overall.setdefault(record["case"], CaseStats()).add(record["success"], wall_time)
+        return history
+
+    # Chance the case fails in this workspace: its own record, smoothed towards its failure rate overall.
+    def failure_probability(self, workspace: str, name: str) -> float:
+        overall = self.overall.get(name, CaseStats())
+        prior = (overall.failures + 1) / (overall.runs + 2)
+        own = self.workspaces.get(workspace, {}).get(name, CaseStats())
+        return (own.failures + 2 * prior) / (own.runs + 2)
+
+    def cost(self, workspace: str, case: Union[Case, MalformedCase]) -> float:
+        for stats in (self.workspaces.get(workspace, {}).get(case.name), self.overall.get(case.name)):
+            if stats is not None and stats.timed_runs > 0:
+                return stats.wall_time / stats.timed_runs
+        if isinstance(case, Case) and os.path.isfile(case.input_doc_path):
+            return DEFAULT_COST + os.path.getsize(case.input_doc_path) / DEFAULT_SPEED
+        return DEFAULT_COST
+
+    # Cases by expected failures per second, highest first; ties keep their order.
+    def order(self, workspace: str, cases: List[Union[Case, MalformedCase]]) -> List[Union[Case, MalformedCase]]:
+        return sorted(
+            cases,
+            key=lambda case: -self.failure_probability(workspace, case.name) / max(self.cost(workspace, case), 1e-3),
+        )
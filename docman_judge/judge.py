@@ -1,11 +1,30 @@
+import codecs
+import functools
+import hashlib
+import io
+import json
+import math
 import os
+import shutil
+import signal
 import subprocess
-from dataclasses import dataclass
-from typing import List, Tuple, Union
-
-from termcolor import colored
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Iterator, List, TextIO, Tuple, Union
 
 from docman_judge.cases import Case, MalformedCase
+from docman_judge.correct import check_bracket_match
+from docman_judge.launcher import launcher_path
+from docman_judge.lookup import citation_file_lookup_keys
+from docman_judge.profiling import span
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 
 @dataclass
@@ -13,95 +32,879 @@ class JudgeResult:
     title: str
     success: bool
     log: str
+    # wall_time, user_time, sys_time in seconds and max_rss in KiB of the student program, if it ran.
+    usage: Union[None, Dict[str, float]] = None
+    # Figures about several runs, kept apart from `usage`: the totals and percentiles of summarize_usage(), the
+    # growth fit of grade_scaling().
+    stats: Union[None, Dict[str, float]] = None
+    # Why the case ended abnormally: "timeout", "skipped" if it never ran, or a limit it exceeded: "output-limit",
+    # "memory-limit", "cpu-limit", "file-size-limit" or "process-limit". "judge-error" marks a workspace the judge
+    # failed to judge, e.g. because its worker process died: it is judged again on --resume.
+    outcome: Union[None, str] = None
+    case: Union[None, str] = None  # name of the case, if it is a case's result
+    # Where the output first differs from the expected one and what surrounds it there, see find_mismatch().
+    diff: Union[None, Dict[str, Union[int, str]]] = None
+
+
+@dataclass
+class BuildOptions:
+    jobs: int = os.cpu_count() or 1
+    ccache: bool = False
+    incremental: bool = True
+
+
+# Citation files don't change during a run, and every workspace runs every case.
+@functools.lru_cache(maxsize=4096)
+def count_lookups(citation_path: Union[str, os.PathLike]) -> int:
+    return len(citation_file_lookup_keys(citation_path))
+
+
+# Per-case limits on the student program, where the platform has setrlimit() (Linux, macOS): applied by prlimit,
+# see spawn_exe().
+# None means unlimited. The process limit counts every process and thread of the user running the judge, the
+# judge's own threads and the other cases included, so it only stops runaway forking; it doesn't apply to root.
+@dataclass
+class ResourceLimits:
+    address_space: Union[None, int] = None  # bytes of virtual memory
+    cpu_time: Union[None, int] = None  # CPU seconds, user and system
+    file_size: Union[None, int] = None  # bytes of any file the program writes
+    processes: Union[None, int] = None
+
+    def rlimits(self) -> List[Tuple[int, Tuple[int, int]]]:
+        if resource is None:
+            return []
+        limits = []
+        if self.address_space is not None:
+            limits.append((resource.RLIMIT_AS, (self.address_space, self.address_space)))
+        if self.cpu_time is not None:
+            # SIGXCPU at the soft limit, SIGKILL a second later if the program survives it.
+            limits.append((resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time + 1)))
+        if self.file_size is not None:
+            limits.append((resource.RLIMIT_FSIZE, (self.file_size, self.file_size)))
+        if self.processes is not None and hasattr(resource, "RLIMIT_NPROC"):
+            limits.append((resource.RLIMIT_NPROC, (self.processes, self.processes)))
+        return limits
+
+    # Which limit the program ran into, judging by how it ended. A failed allocation only shows up as what
+    # the program makes of it, so the memory limit is recognized by the usual messages of an uncaught one.
+    def violation(self, code: int, usage: Dict[str, float], stderr: str) -> Union[None, str]:
+        if resource is None or code == 0:
+            return None
+        if self.cpu_time is not None and (
+            code == -signal.SIGXCPU
+            or (code == -signal.SIGKILL and usage.get("user_time", 0) + usage.get("sys_time", 0) >= self.cpu_time)
+        ):
+            return "cpu-limit"
+        if self.file_size is not None and (code == -signal.SIGXFSZ or FILE_TOO_LARGE in stderr):
+            return "file-size-limit"
+        if self.address_space is not None and any(message in stderr for message in ALLOCATION_FAILURES):
+            return "memory-limit"
+        if self.processes is not None and FORK_FAILURE in stderr:
+            return "process-limit"
+        return None
+
+    # Refuses limits the judge can't put the program under, which would fail every case before the program
+    # starts: hard limits above the judge's own, which only root may raise, and too little memory to load it.
+    def check(self) -> None:
+        if self.address_space is not None and self.address_space < MIN_ADDRESS_SPACE:
+            raise ValueError(f"a memory limit of {self.address_space} bytes is too low to load a program")
+        for which, (soft, hard) in self.rlimits():
+            current = resource.getrlimit(which)[1]
+            if current != resource.RLIM_INFINITY and max(soft, hard) > current:
+                raise ValueError(
+                    f"{PRLIMIT_OPTIONS[which].lstrip('-')} limit {max(soft, hard)} is above the hard limit of "
+                    f"the judge, {current}"
+                )
+
+
+# The program couldn't be started under the limits, a failure of the judge rather than of the program.
+class LimitsError(Exception):
+    pass
+
+
+ALLOCATION_FAILURES = ("std::bad_alloc", "MemoryError", "Cannot allocate memory", "out of memory")
+FORK_FAILURE = "Resource temporarily unavailable"  # strerror(EAGAIN), what a failing fork() reports
+FILE_TOO_LARGE = "File too large"  # strerror(EFBIG), for programs ignoring SIGXFSZ
+MIN_ADDRESS_SPACE = 16 << 20  # a small C++ program needs about 6 MiB to map its shared libraries
+LOADER_FAILURE = "error while loading shared libraries"  # the dynamic loader, exiting with 127
+
+PRLIMIT = shutil.which("prlimit")  # util-linux: sets limits on itself, then executes the program
+PRLIMIT_OPTIONS: Dict[int, str] = {}
+if resource is not None:
+    PRLIMIT_OPTIONS = {resource.RLIMIT_AS: "--as", resource.RLIMIT_CPU: "--cpu", resource.RLIMIT_FSIZE: "--fsize"}
+    if hasattr(resource, "RLIMIT_NPROC"):
+        PRLIMIT_OPTIONS[resource.RLIMIT_NPROC] = "--nproc"
+
+
+def set_rlimits(limits: List[Tuple[int, Tuple[int, int]]]) -> None:
+    for which, limit in limits:
+        resource.setrlimit(which, limit)
+
 
+# How the student program is run for each case.
+# A case gets `timeout` seconds plus `timeout_per_mib` seconds per MiB of input and citation, plus
+# `timeout_per_lookup` seconds per ISBN or URL its citations make it look up over the network, at most
+# `max_timeout`; cases which can't get to read any input (malformed arguments, missing files) get `quick_timeout`.
+@dataclass
+class RunOptions:
+    timeout: float = 10
+    timeout_per_mib: float = 10
+    timeout_per_lookup: float = 5
+    quick_timeout: float = 5
+    max_timeout: float = 600
+    deadline: Union[None, float] = None  # seconds for all the cases of a workspace
+    max_consecutive_timeouts: Union[None, int] = None
+    output_limit: Union[None, int] = 64 << 20  # bytes a case may write to stdout and stderr
+    diff_context: int = 100  # characters shown on each side of the first difference of a mismatch
+    limits: ResourceLimits = field(default_factory=ResourceLimits)
+    engine: str = "threads"  # or "asyncio", see docman_judge.engine
+
+    def timeout_for(self, case: Union[Case, MalformedCase]) -> float:
+        if isinstance(case, MalformedCase) or not (
+            os.path.isfile(case.input_doc_path) and os.path.isfile(case.input_citation)
+        ):
+            return min(self.quick_timeout, self.max_timeout)
+        size = os.path.getsize(case.input_doc_path) + os.path.getsize(case.input_citation)
+        lookups = count_lookups(case.input_citation)
+        return min(
+            self.timeout + self.timeout_per_mib * size / (1 << 20) + self.timeout_per_lookup * lookups,
+            self.max_timeout,
+        )
+
+    # The cap is on top of the answer the case expects on stdout, so a large performance case can print it.
+    def output_limit_for(self, case: Union[Case, MalformedCase]) -> Union[None, int]:
+        if self.output_limit is None or isinstance(case, MalformedCase) or case.output is not None:
+            return self.output_limit
+        if case.expect_path is not None and os.path.isfile(case.expect_path):
+            return self.output_limit + os.path.getsize(case.expect_path)
+        if case.expect_output is not None:
+            return self.output_limit + len(case.expect_output.encode())
+        return self.output_limit
+
+    # Scale the per-MiB budget to this host: allow `slack` times what the reference bracket matcher takes.
+    def calibrate(self, slack: float = 100) -> None:
+        article = ("Lorem ipsum dolor sit amet [ref] " * (1 << 15))[: 1 << 20]
+        time_start = time.perf_counter()
+        check_bracket_match(article)
+        self.timeout_per_mib = max(self.timeout_per_mib, slack * (time.perf_counter() - time_start))
+
+
+EXE_NAME = "docman.exe" if os.name == "nt" else "docman"
+# Characters of stdout and stderr kept in the log of a run; longer streams keep their head and tail.
+LOG_LIMIT = 4096
+BUILD_STAMP = ".docman-judge-build.json"
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Every file in the workspace except the build directory and hidden ones (.git, .vscode...), in a stable order.
+def source_files(path: str) -> Iterator[str]:
+    for root, dirs, filenames in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and not (root == path and d == "build"))
+        for filename in sorted(filenames):
+            yield os.path.join(root, filename)
 
-def build(path: str) -> JudgeResult:
-    os.chdir(path)
-    if not os.path.exists("CMakeLists.txt"):
+
+def hash_sources(path: str) -> str:
+    digest = hashlib.sha256()
+    for file_path in source_files(path):
+        digest.update(os.path.relpath(file_path, path).encode(errors="surrogatepass") + b"\0")
+        digest.update(hash_file(file_path).encode())
+    return digest.hexdigest()
+
+
+def read_build_stamp(path: str) -> Union[None, dict]:
+    try:
+        with open(os.path.join(path, "build", BUILD_STAMP), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cmake_generator(path: str) -> str:
+    if os.name == "nt":
+        return ' -G "MinGW Makefiles"'
+    if shutil.which("ninja") is None:
+        return ""
+    # The generator of an existing build directory can't be changed, so Ninja is only picked for fresh ones.
+    try:
+        with open(os.path.join(path, "build", "CMakeCache.txt"), "r", errors="ignore") as f:
+            if "CMAKE_GENERATOR:INTERNAL=Ninja\n" not in f.read():
+                return ""
+    except OSError:
+        pass
+    return " -G Ninja"
+
+
+def build(path: str, options: Union[None, BuildOptions] = None) -> JudgeResult:
+    if options is None:
+        options = BuildOptions()
+    if not os.path.exists(os.path.join(path, "CMakeLists.txt")):
         return JudgeResult("pre-configure", False, "No build system found.")
 
-    config_command = "cmake -B ./build" + (' -G "MinGW Makefiles"' if os.name == "nt" else "")
-    cfg_r = subprocess.run(config_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    exe_path = os.path.join(path, "build", EXE_NAME)
+    sources_hash = hash_sources(path)
+    if options.incremental and os.path.exists(exe_path):
+        stamp = read_build_stamp(path)
+        if stamp is not None and stamp == {"sources": sources_hash, "binary": hash_file(exe_path)}:
+            return JudgeResult("build", True, "Sources unchanged since the last successful build, skipped.")
+
+    config_command = "cmake -B ./build" + cmake_generator(path)
+    if options.ccache and shutil.which("ccache") is not None:
+        config_command += " -DCMAKE_C_COMPILER_LAUNCHER=ccache -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
+    with span("cmake configure", "build", workspace=path):
+        cfg_r = subprocess.run(config_command, shell=True, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     output = cfg_r.stdout.decode(errors="ignore") + cfg_r.stderr.decode(errors="ignore")
     if cfg_r.returncode != 0:
         return JudgeResult("configure", False, output)
 
-    build_command = "cmake --build ./build"
-    build_r = subprocess.run(build_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    build_command = f"cmake --build ./build --parallel {options.jobs}"
+    with span("cmake build", "build", workspace=path):
+        build_r = subprocess.run(build_command, shell=True, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     output += build_r.stdout.decode(errors="ignore") + build_r.stderr.decode(errors="ignore")
     if build_r.returncode != 0:
         return JudgeResult("build", False, output)
 
+    if os.path.exists(exe_path):
+        with open(os.path.join(path, "build", BUILD_STAMP), "w") as f:
+            json.dump({"sources": sources_hash, "binary": hash_file(exe_path)}, f)
     return JudgeResult("build", True, output)
 
 
-def run_exe(path: str, args: List[str], rediect_input: Union[None, str]) -> Tuple[str, int, str, bool]:
-    args = [path] + args
+# Popen that reaps its child with wait4(), keeping the resource usage of the child. A program started through
+# the launcher (see docman_judge.launcher) reports its own peak memory on `usage_pipe`.
+class MeasuredPopen(subprocess.Popen):
+    rusage = None
+    usage_pipe: Union[None, int] = None
+    launched_rss: Union[None, int] = None  # KiB
+
+    def kill(self) -> None:
+        if self.usage_pipe is None:
+            return super().kill()
+        self.terminate()  # the launcher kills the program, then still reports on it
+
+    # Once the launcher has exited.
+    def read_launched_rss(self) -> None:
+        if self.usage_pipe is None:
+            return
+        with os.fdopen(self.usage_pipe, "rb") as f:
+            self.usage_pipe = None
+            report = f.read()
+        try:
+            self.launched_rss = int(report)
+        except ValueError:  # killed before reporting
+            pass
+
+    def _try_wait(self, wait_flags):
+        if not hasattr(os, "wait4"):
+            return super()._try_wait(wait_flags)
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+
+def get_usage(proc: MeasuredPopen, wall_time: float) -> Dict[str, float]:
+    usage = {"wall_time": wall_time}
+    if proc.rusage is not None:
+        usage["user_time"] = proc.rusage.ru_utime
+        usage["sys_time"] = proc.rusage.ru_stime
+    proc.read_launched_rss()
+    if proc.launched_rss is not None:
+        usage["max_rss"] = proc.launched_rss
+    elif proc.rusage is not None and not sys.platform.startswith("linux"):
+        # ru_maxrss is in bytes on macOS, in KiB elsewhere. On Linux it is at least the judge's own peak, so
+        # without the launcher there is no telling the program's.
+        usage["max_rss"] = proc.rusage.ru_maxrss // 1024 if sys.platform == "darwin" else proc.rusage.ru_maxrss
+    return usage
+
+
+# Reads a text stream as if its trailing '\n', if any, was removed, like str.removesuffix("\n").
+class TrimmedText:
+    def __init__(self, stream: TextIO) -> None:
+        self.stream = stream
+        self.held = ""  # the last character read, until it is known not to be the final one
+
+    def read(self, size: int) -> str:
+        text = self.held + self.stream.read(size + 1 - len(self.held))
+        if len(text) == size + 1:
+            self.held = text[-1]
+            return text[:-1]
+        self.held = ""
+        return text.removesuffix("\n")
+
+
+# The expected output of a case, from memory or, for cases too large to hold it, from a file.
+def open_expected(expect_output: Union[str, os.PathLike]) -> TextIO:
+    if isinstance(expect_output, str):
+        return io.StringIO(expect_output)
+    return open(expect_output, "r", encoding="utf-8", newline="")
+
+
+# The stdout of a program an OutputMonitor compared as it was printed, in place of the whole of it: its first
+# `matched` characters were the expected output, and `rest` followed them when it was stopped. `mismatch`
+# tells whether it differed from the expected output at all, `rest` being empty when it was only too short.
+@dataclass
+class MonitoredOutput:
+    matched: int
+    rest: str
+    mismatch: bool
+
+
+# Reads back a MonitoredOutput as a text stream, the matched part being read from the expected output.
+class MatchedText:
+    def __init__(self, expected: TextIO, output: MonitoredOutput) -> None:
+        self.expected = expected
+        self.left = output.matched
+        self.rest = output.rest
+
+    def read(self, size: int) -> str:
+        text = ""
+        if self.left > 0:
+            want = min(size, self.left)
+            text = self.expected.read(want)
+            text += "\n" * (want - len(text))  # past its end, only the optional final '\n' can have matched
+            self.left -= want
+        take = size - len(text)
+        text, self.rest = text + self.rest[:take], self.rest[take:]
+        return text
+
+
+# Keeps the first and last `limit` // 2 bytes of a stream for the log, for a stream too large to hold.
+class HeadAndTail:
+    def __init__(self, limit: int = LOG_LIMIT) -> None:
+        self.half = limit // 2
+        self.head = b""
+        self.tail: List[bytes] = []
+        self.tail_size = 0
+        self.omitted = 0
+
+    def append(self, chunk: bytes) -> None:
+        if len(self.head) < self.half:
+            taken = chunk[: self.half - len(self.head)]
+            self.head += taken
+            chunk = chunk[len(taken) :]
+        self.tail.append(chunk)
+        self.tail_size += len(chunk)
+        if self.tail_size > 2 * self.half:  # trimmed now and then rather than at every chunk
+            tail = b"".join(self.tail)
+            self.omitted += len(tail) - self.half
+            self.tail, self.tail_size = [tail[-self.half :]], self.half
+
+    # Like truncate_middle() over the whole stream.
+    def text(self) -> str:
+        tail = b"".join(self.tail)
+        if len(tail) > self.half:
+            self.omitted += len(tail) - self.half
+            tail = tail[-self.half :]
+        if self.omitted == 0:
+            return (self.head + tail).decode(errors="ignore")
+        head, tail = self.head.decode(errors="ignore"), tail.decode(errors="ignore")
+        return f"{head}\n... [{self.omitted} bytes omitted] ...\n{tail}"
+
+
+# Watches the output of a case while it runs. It stops the case once stdout can no longer match
+# `expect_output` (the trailing '\n' being optional, as in check_case), or once stdout and stderr
+# together exceed `limit` bytes. The expected output is read along, so it can be a file of any size, and
+# result() tells how stdout compared, so it needn't be kept.
+class OutputMonitor:
+    def __init__(self, expect_output: Union[None, str, os.PathLike], limit: Union[None, int]) -> None:
+        self.file = None if expect_output is None else open_expected(expect_output)
+        self.target = None if self.file is None else TrimmedText(self.file)
+        self.final_newline = False  # whether the optional final '\n' was printed
+        self.limit = limit
+        self.written = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.pending_cr = ""
+        self.matched = 0  # characters of stdout that matched so far
+        self.rest = ""  # what followed them, once stdout differed
+        self.complete = True  # whether all of the expected output was printed, known after finish()
+        self.last = ""  # the last character matched
+        self.stopped: Union[None, str] = None
+        self.lock = threading.Lock()
+
+    def feed(self, chunk: bytes, compare: bool) -> bool:
+        with self.lock:
+            self.written += len(chunk)
+            if self.stopped is None and self.limit is not None and self.written > self.limit:
+                self.stopped = "output-limit"
+            if self.stopped is None and compare and self.target is not None:
+                self.compare(chunk)
+            return self.stopped is None
+
+    def compare(self, chunk: bytes) -> None:
+        text = self.pending_cr + self.decoder.decode(chunk)
+        # A '\r' at the end of a chunk may be the first half of a "\r\n".
+        self.pending_cr = "\r" if text.endswith("\r") else ""
+        self.compare_text(text.removesuffix("\r").replace("\r\n", "\n"))
+
+    def compare_text(self, text: str) -> None:
+        expected = self.target.read(len(text))
+        if len(expected) < len(text) and not self.final_newline:
+            expected += "\n"
+            self.final_newline = True
+        if expected == text:
+            self.matched += len(text)
+            self.last = text[-1:] or self.last
+            return
+        common = first_difference(expected, text)
+        self.matched += common
+        self.rest = text[common:]
+        self.stopped = "mismatch"
+
+    # Compares what is left once the program exited, then whether it printed all of the expected output.
+    def finish(self) -> None:
+        if self.target is None or self.stopped is not None:
+            return
+        text = self.pending_cr + self.decoder.decode(b"", final=True)
+        self.pending_cr = ""
+        if text:
+            self.compare_text(text)
+        if self.stopped is None:
+            # A final '\n' that matched a '\n' of the expected output rather than the optional one doesn't count.
+            self.complete = self.target.read(1) == "" and (self.final_newline or self.last != "\n")
+
+    def result(self) -> MonitoredOutput:
+        return MonitoredOutput(self.matched, self.rest, self.stopped == "mismatch" or not self.complete)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+
+def pump(
+    stream, chunks: Union[List[bytes], HeadAndTail], monitor: OutputMonitor, compare: bool, proc: subprocess.Popen
+) -> None:
+    while chunk := stream.read1(1 << 16):
+        chunks.append(chunk)
+        if not monitor.feed(chunk, compare):
+            proc.kill()
+            break
+
+
+# Starts the program with stdout and stderr piped, under the limits of `limits`.
+def spawn_exe(
+    args: List[str], rediect_input: Union[None, str], cwd: str, limits: Union[None, ResourceLimits] = None
+) -> MeasuredPopen:
+    rlimits = [] if limits is None else limits.rlimits()
+    preexec_fn = None
+    if rlimits and PRLIMIT is not None:
+        options = [f"{PRLIMIT_OPTIONS[which]}={soft}:{hard}" for which, (soft, hard) in rlimits]
+        args = [PRLIMIT, *options, "--", *args]
+    elif rlimits:
+        # Without prlimit, the limits are set by Python code run in the child between fork() and exec(). The
+        # judge has other threads, and a lock one of them held at the fork stays locked in the child: if the
+        # child needs it, the case hangs until its timeout. set_rlimits() keeps that unlikely, not impossible.
+        preexec_fn = functools.partial(set_rlimits, rlimits)
+    launcher = launcher_path()
+    if launcher is None:
+        return popen_exe(args, rediect_input, cwd, preexec_fn)
+    usage_read, usage_write = os.pipe()
+    try:
+        proc = popen_exe([launcher, str(usage_write), *args], rediect_input, cwd, preexec_fn, (usage_write,))
+    except BaseException:
+        os.close(usage_read)
+        raise
+    finally:
+        os.close(usage_write)
+    proc.usage_pipe = usage_read
+    return proc
+
+
+def popen_exe(
+    args: List[str],
+    rediect_input: Union[None, str],
+    cwd: str,
+    preexec_fn: Union[None, Callable[[], None]],
+    pass_fds: Tuple[int, ...] = (),
+) -> MeasuredPopen:
     if rediect_input is None:
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return MeasuredPopen(
+            args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=preexec_fn, pass_fds=pass_fds
+        )
+    with open(rediect_input, "r") as file:  # the program has its own copy of the file descriptor
+        return MeasuredPopen(
+            args,
+            cwd=cwd,
+            stdin=file,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=preexec_fn,
+            pass_fds=pass_fds,
+        )
+
+
+# What run_exe() returns, from what was collected while the program ran. Stdout the monitor compared is
+# returned as its MonitoredOutput, `stdout_chunks` then only keeping its head and tail for the log.
+def run_result(
+    args: List[str],
+    exit_code: int,
+    stdout_chunks: Union[List[bytes], HeadAndTail],
+    stderr_chunks: List[bytes],
+    timeout: bool,
+    usage: Dict[str, float],
+    monitor: OutputMonitor,
+    limits: Union[None, ResourceLimits] = None,
+) -> Tuple[Union[str, MonitoredOutput], int, str, bool, Dict[str, float], Union[None, str]]:
+    if isinstance(stdout_chunks, HeadAndTail):
+        stdout, stdout_log = monitor.result(), stdout_chunks.text()
     else:
-        file = open(rediect_input, "r")
-        proc = subprocess.Popen(args, stdin=file, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout = b"".join(stdout_chunks).decode(errors="ignore")
+        stdout_log = truncate_middle(stdout)
+    stderr = b"".join(stderr_chunks).decode(errors="ignore")
+    if limits is not None and limits.rlimits():
+        # prlimit reports failing to set a limit or to execute the program itself, and the loader running out
+        # of memory exits with 127: either way the program never ran.
+        if (PRLIMIT is not None and exit_code in (1, 126, 127) and stderr.startswith("prlimit: ")) or (
+            exit_code == 127 and LOADER_FAILURE in stderr
+        ):
+            raise LimitsError(f"The program could not start under the resource limits: {stderr.strip()}")
+    log = " ".join([str(i) for i in args]) + "\n" + stdout_log + "\n" + truncate_middle(stderr)
+    stopped = monitor.stopped
+    if stopped is None and not timeout and limits is not None:
+        stopped = limits.violation(exit_code, usage, stderr)
+    return stdout, exit_code, log, timeout, usage, stopped
+
+
+# Returns (stdout, exit code, log, timeout, usage, stopped), `stopped` being "mismatch" or "output-limit"
+# when the OutputMonitor killed the program early, or the limit of `limits` the program ran into. Stdout
+# compared against `expect_output` is only returned as a MonitoredOutput.
+def run_exe(
+    path: str,
+    args: List[str],
+    rediect_input: Union[None, str],
+    cwd: str,
+    time_limit: float = 60,
+    expect_output: Union[None, str] = None,
+    output_limit: Union[None, int] = None,
+    limits: Union[None, ResourceLimits] = None,
+) -> Tuple[Union[str, MonitoredOutput], int, str, bool, Dict[str, float], Union[None, str]]:
+    args = [path] + args
+    with span("run_exe", "run", args=" ".join(str(arg) for arg in args)):
+        time_start = time.perf_counter()
+        proc = spawn_exe(args, rediect_input, cwd, limits)
+
+        monitor = OutputMonitor(expect_output, output_limit)
+        stdout_chunks = [] if expect_output is None else HeadAndTail()
+        stderr_chunks = []
+        readers = [
+            threading.Thread(target=pump, args=(proc.stdout, stdout_chunks, monitor, True, proc), daemon=True),
+            threading.Thread(target=pump, args=(proc.stderr, stderr_chunks, monitor, False, proc), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
 
-    timeout = False
-    try:  # timeout if 60 seconds passed without ending the process.
-        stdout, stderr = proc.communicate(timeout=60)
-    except subprocess.TimeoutExpired:
-        timeout = True
-        proc.kill()
-        stdout, stderr = proc.communicate()
+        timeout = False
+        try:  # timeout if time_limit seconds passed without ending the process.
+            proc.wait(timeout=time_limit)
+        except subprocess.TimeoutExpired:
+            timeout = True
+            proc.kill()
+            proc.wait()
+        usage = get_usage(proc, time.perf_counter() - time_start)
+        for reader in readers:
+            reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        monitor.finish()
+        monitor.close()
+        return run_result(args, proc.returncode, stdout_chunks, stderr_chunks, timeout, usage, monitor, limits)
 
-    if rediect_input is not None:
-        file.close()
 
-    exit_code = proc.returncode
-    stdout = stdout.decode(errors="ignore")
-    stderr = stderr.decode(errors="ignore")
-    return stdout, exit_code, " ".join([str(i) for i in args]) + "\n" + stdout + "\n" + stderr, timeout
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
 
 
+# Totals and percentiles of the resource usage of a workspace's cases, logged as a "usage" result.
+def summarize_usage(results: List[JudgeResult]) -> Union[None, JudgeResult]:
+    usages = [result.usage for result in results if result.usage is not None]
+    if len(usages) == 0:
+        return None
+
+    summary = {"cases": len(usages)}
+    lines = [f"{'':<10}{'total':>12}{'p50':>12}{'p90':>12}{'p99':>12}{'max':>12}"]
+    for key in ("wall_time", "user_time", "sys_time", "max_rss"):
+        values = [usage[key] for usage in usages if key in usage]
+        if len(values) == 0:
+            continue
+        # Peak memory doesn't add up, its "total" is the peak over all cases.
+        summary[key] = max(values) if key == "max_rss" else sum(values)
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)):
+            summary[f"{key}_{name}"] = percentile(values, q)
+        lines.append(
+            f"{key:<10}{summary[key]:>12.3f}"
+            + "".join(f"{summary[f'{key}_{name}']:>12.3f}" for name in ("p50", "p90", "p99", "max"))
+        )
+    lines.append("(times in seconds, max_rss in KiB)")
+    return JudgeResult("usage", True, "\n".join(lines), stats=summary)
+
+
+def truncate_middle(text: str, limit: int = LOG_LIMIT) -> str:
+    if len(text) <= limit:
+        return text
+    return f"{text[: limit // 2]}\n... [{len(text) - limit} characters omitted] ...\n{text[-(limit // 2) :]}"
+
+
+# The first line of a log is the reason of the result; loggers may highlight it.
 def format_log_message(reason: str, log: str) -> str:
-    return f"{colored(reason, 'blue')}\n{colored('Output', 'yellow')}:\n{log}"
+    return f"{reason}\nOutput:\n{log}"
+
+
+# Index of the first character where `a` and `b` differ, min(len(a), len(b)) if one is a prefix of the other.
+# Slices are compared a chunk at a time, then bisected within the differing chunk, so the characters
+# are only ever compared by str.__eq__.
+def first_difference(a: str, b: str, chunk: int = 1 << 16) -> int:
+    n = min(len(a), len(b))
+    lo = 0
+    while lo < n and a[lo : min(lo + chunk, n)] == b[lo : min(lo + chunk, n)]:
+        lo += chunk
+    if lo >= n:
+        return n
+    hi = min(lo + chunk, n)
+    while hi - lo > 1:  # a[:lo] == b[:lo] and a[lo:hi] != b[lo:hi]
+        mid = (lo + hi) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+# Where `actual` first differs from `expected`: offset, 1-based line and column, and `context` characters
+# around it in both strings.
+def find_mismatch(expected: str, actual: str, context: int = 100) -> Dict[str, Union[int, str]]:
+    offset = first_difference(expected, actual)
+    start = max(0, offset - context)
+    return {
+        "offset": offset,
+        "line": expected.count("\n", 0, offset) + 1,
+        "column": offset - (expected.rfind("\n", 0, offset) + 1) + 1,
+        "context_start": start,
+        "expected": expected[start : offset + context + 1],
+        "actual": actual[start : offset + context + 1],
+        "expected_length": len(expected),
+        "actual_length": len(actual),
+    }
 
 
-def test(path: str, case: Union[Case, MalformedCase]) -> JudgeResult:
-    os.chdir(path)
-    exe_path = os.path.join(path, "build", "docman.exe" if os.name == "nt" else "docman")
+# find_mismatch() over two text streams, in constant memory; None if they match. Like check_case, it doesn't
+# consider a trailing '\n'.
+def find_stream_mismatch(
+    expected: TextIO, actual: TextIO, context: int = 100, chunk: int = 1 << 16
+) -> Union[None, Dict[str, Union[int, str]]]:
+    expected, actual = TrimmedText(expected), TrimmedText(actual)
+    offset, lines, line_start, before = 0, 0, 0, ""  # `before`: up to `context` characters before `offset`
+    while True:
+        a, b = expected.read(chunk), actual.read(chunk)
+        common = a if a == b else a[: first_difference(a, b)]
+        lines += common.count("\n")
+        if "\n" in common:
+            line_start = offset + common.rfind("\n") + 1
+        before = (before + common)[-context:] if context > 0 else ""
+        offset += len(common)
+        if a == b and len(a) == 0:
+            return None
+        if a != b:
+            break
+
+    def window_and_length(rest: str, stream: TrimmedText) -> Tuple[str, int]:
+        window, length = rest[: context + 1], offset + len(rest)
+        while more := stream.read(chunk):
+            window += more[: context + 1 - len(window)]
+            length += len(more)
+        return before + window, length
+
+    expected_window, expected_length = window_and_length(a[len(common) :], expected)
+    actual_window, actual_length = window_and_length(b[len(common) :], actual)
+    return {
+        "offset": offset,
+        "line": lines + 1,
+        "column": offset - line_start + 1,
+        "context_start": offset - len(before),
+        "expected": expected_window,
+        "actual": actual_window,
+        "expected_length": expected_length,
+        "actual_length": actual_length,
+    }
+
+
+def describe_char(s: str, offset: int) -> str:
+    return repr(s[offset]) if offset < len(s) else "<EOF>"
+
+
+# Renders a find_mismatch() result; `highlight(text, color)` may colorize it, as TermLogger does.
+def format_diff(diff: Dict[str, Union[int, str]], highlight: Callable[[str, str], str] = lambda text, _: text) -> str:
+    at = diff["offset"] - diff["context_start"]
+    lines = [
+        highlight(f"Output mismatch at line {diff['line']}, column {diff['column']} (offset {diff['offset']}).", "blue")
+    ]
+    for name in ("expected", "actual"):
+        window = diff[name]
+        end = diff["context_start"] + len(window)
+        lines.append(
+            highlight(f"{name.capitalize()} [{diff['context_start']}:{end} of {diff[f'{name}_length']}]:", "yellow")
+        )
+        lines.append(f"{window[:at]}{highlight(window[at : at + 1], 'red')}{window[at + 1 :]}")
+    lines.append(f"expect {describe_char(diff['expected'], at)}, get {describe_char(diff['actual'], at)}")
+    return "\n".join(lines)
+
+
+# The executable to test and the time limit of `case`, or the result of a case that cannot run.
+# `deadline` is the time.monotonic() by which all cases of the workspace must be done.
+def prepare_test(
+    path: str, case: Union[Case, MalformedCase], options: RunOptions, deadline: Union[None, float] = None
+) -> Tuple[str, float, Union[None, JudgeResult]]:
+    exe_path = os.path.join(path, "build", EXE_NAME)
     if not os.path.exists(exe_path):
-        return JudgeResult("pretest", False, "Output executable file docman does not exist.")
-    if isinstance(case, MalformedCase):
-        _, code, log, timeout = run_exe(exe_path, case.args, None)  # Malformed ones shouldn't accept any input...
-        if timeout:
-            return JudgeResult(
-                "test",
-                False,
-                format_log_message("Case timeout.", log),
-            )
-        if code == 0:
-            return JudgeResult(
-                "test",
-                False,
-                format_log_message("Malformed case should not pass.", log),
-            )
-        elif code == 1:
-            return JudgeResult(
-                "test",
-                True,
-                format_log_message("Failed as expected.", log),
+        return exe_path, 0, JudgeResult("pretest", False, "Output executable file docman does not exist.")
+    time_limit = options.timeout_for(case)
+    if deadline is not None:
+        time_limit = min(time_limit, deadline - time.monotonic())
+        if time_limit <= 0:
+            return (
+                exe_path,
+                0,
+                JudgeResult("test", False, "Workspace deadline exceeded, case skipped.", outcome="skipped"),
             )
+    return exe_path, time_limit, None
+
+
+def test(
+    path: str,
+    case: Union[Case, MalformedCase],
+    options: Union[None, RunOptions] = None,
+    deadline: Union[None, float] = None,
+) -> JudgeResult:
+    if options is None:
+        options = RunOptions()
+    exe_path, time_limit, refused = prepare_test(path, case, options, deadline)
+    if refused is not None:
+        return refused
+    # Every case runs in its own scratch directory, so cases can be tested concurrently
+    # without racing on output files or on the process-wide working directory.
+    with span("test", "run", case=case.name), TemporaryDirectory(prefix="docman-case-") as scratch:
+        return test_in_dir(
+            exe_path, case, scratch, time_limit, options.output_limit_for(case), options.diff_context, options.limits
+        )
+
+
+# What to run for `case`: (arguments, file redirected to stdin, expected stdout to compare while it runs).
+def case_command(
+    case: Union[Case, MalformedCase],
+) -> Tuple[List[str], Union[None, str], Union[None, str, os.PathLike]]:
+    if isinstance(case, MalformedCase):
+        return case.args, None, None  # Malformed ones shouldn't accept any input...
+    redirect_input = case.input_doc_path if case.need_redirect else None
+    # Only an answer printed to stdout can be compared while the program runs.
+    expect_output = None
+    if case.output is None and not case.should_error():
+        expect_output = case.expect_output if case.expect_path is None else case.expect_path
+    return case.generate_args(), redirect_input, expect_output
+
+
+# Judges what run_exe() returned for `case`.
+def check_run(
+    case: Union[Case, MalformedCase],
+    scratch: str,
+    run: Tuple[Union[str, MonitoredOutput], int, str, bool, Dict[str, float], Union[None, str]],
+    diff_context: int = 100,
+) -> JudgeResult:
+    output, code, log, timeout, usage, stopped = run
+    with span("compare", "check"):
+        if isinstance(case, MalformedCase):
+            result = check_malformed(code, log, timeout, stopped)
         else:
-            return JudgeResult(
-                "test",
-                False,
-                format_log_message("Error code should be 1 when failed.", log),
-            )
-    args = case.generate_args()
-    output, code, log, timeout = run_exe(exe_path, args, case.input_doc_path if case.need_redirect else None)
+            result = check_case(case, scratch, output, code, log, timeout, stopped, diff_context)
+    result.usage = usage
+    return result
+
+
+def test_in_dir(
+    exe_path: str,
+    case: Union[Case, MalformedCase],
+    scratch: str,
+    time_limit: float,
+    output_limit: Union[None, int] = None,
+    diff_context: int = 100,
+    limits: Union[None, ResourceLimits] = None,
+) -> JudgeResult:
+    args, redirect_input, expect_output = case_command(case)
+    run = run_exe(exe_path, args, redirect_input, scratch, time_limit, expect_output, output_limit, limits)
+    return check_run(case, scratch, run, diff_context)
+
+
+LIMIT_MESSAGES = {
+    "output-limit": "Output limit exceeded.",
+    "memory-limit": "Memory limit exceeded.",
+    "cpu-limit": "CPU time limit exceeded.",
+    "file-size-limit": "Output file size limit exceeded.",
+    "process-limit": "Process limit exceeded.",
+}
+
+
+def limit_result(outcome: str, log: str) -> JudgeResult:
+    return JudgeResult("test", False, format_log_message(LIMIT_MESSAGES[outcome], log), outcome=outcome)
+
+
+def check_malformed(code: int, log: str, timeout: bool, stopped: Union[None, str] = None) -> JudgeResult:
+    if stopped in LIMIT_MESSAGES:
+        return limit_result(stopped, log)
     if timeout:
         return JudgeResult(
             "test",
             False,
             format_log_message("Case timeout.", log),
+            outcome="timeout",
+        )
+    if code == 0:
+        return JudgeResult(
+            "test",
+            False,
+            format_log_message("Malformed case should not pass.", log),
+        )
+    elif code == 1:
+        return JudgeResult(
+            "test",
+            True,
+            format_log_message("Failed as expected.", log),
+        )
+    else:
+        return JudgeResult(
+            "test",
+            False,
+            format_log_message("Error code should be 1 when failed.", log),
+        )
+
+
+def check_case(
+    case: Case,
+    scratch: str,
+    output: Union[str, MonitoredOutput],
+    code: int,
+    log: str,
+    timeout: bool,
+    stopped: Union[None, str] = None,
+    diff_context: int = 100,
+) -> JudgeResult:
+    output_path = None if case.output is None else os.path.join(scratch, case.output)
+    if stopped in LIMIT_MESSAGES:
+        return limit_result(stopped, log)
+    if timeout:
+        return JudgeResult(
+            "test",
+            False,
+            format_log_message("Case timeout.", log),
+            outcome="timeout",
         )
     if case.should_error():
         if code == 0:
@@ -110,7 +913,7 @@ def test(path: str, case: Union[Case, MalformedCase]) -> JudgeResult:
                 False,
                 format_log_message("Case should error but passed.", log),
             )
-        elif case.output is not None and os.path.exists(case.output):
+        elif output_path is not None and os.path.exists(output_path):
             return JudgeResult(
                 "test",
                 False,
@@ -128,7 +931,7 @@ def test(path: str, case: Union[Case, MalformedCase]) -> JudgeResult:
                 False,
                 format_log_message("Error code should be 1 when failed.", log),
             )
-    else:  # Should pass...
+    elif stopped is None:  # Should pass... (unless killed on the first wrong output, then go on to the diff)
         if code != 0:
             return JudgeResult(
                 "test",
@@ -137,52 +940,42 @@ def test(path: str, case: Union[Case, MalformedCase]) -> JudgeResult:
             )
     # Normally passed, check output.
     output_in_memory = ""
-    if case.output is not None:
-        if not os.path.exists(case.output):
+    if output_path is not None:
+        if not os.path.exists(output_path):
             return JudgeResult(
                 "test",
                 False,
                 format_log_message("Output file does not exist.", log),
             )
-        with open(case.output, "r", encoding="utf-8") as f:
+    if isinstance(output, MonitoredOutput):  # compared as it was printed, see OutputMonitor
+        if not output.mismatch:
+            return JudgeResult("test", True, log)
+        expect_output = case.expect_output if case.expect_path is None else case.expect_path
+        with open_expected(expect_output) as expected, open_expected(expect_output) as matched:
+            diff = find_stream_mismatch(expected, MatchedText(matched, output), diff_context)
+        if diff is not None:
+            return JudgeResult("test", False, format_diff(diff), diff=diff)
+        return JudgeResult("test", True, log)
+    if case.expect_path is not None:  # too large to hold, compared as it is read
+        with (
+            open_expected(case.expect_path) as expected,
+            open(output_path, "r", encoding="utf-8")
+            if output_path is not None
+            else io.StringIO(output.replace("\r\n", "\n")) as actual,
+        ):
+            diff = find_stream_mismatch(expected, actual, diff_context)
+        if diff is not None:
+            return JudgeResult("test", False, format_diff(diff), diff=diff)
+        return JudgeResult("test", True, log)
+    if output_path is not None:
+        with open(output_path, "r", encoding="utf-8") as f:
             output_in_memory = f.read()
     else:  # output in terminal
         output_in_memory = output.replace("\r\n", "\n")
-    case.expect_output = case.expect_output.removesuffix("\n")
+    expect_output = case.expect_output.removesuffix("\n")
     output_in_memory = output_in_memory.removesuffix("\n")  # Don't consider trailing '\n'.
 
-    if output_in_memory != case.expect_output:
-        to_end = True
-        i = 0
-        for i in range(min(len(output_in_memory), len(case.expect_output))):
-            if output_in_memory[i] != case.expect_output[i]:
-                to_end = False
-                break
-
-        def get_char_or_eof(s, idx):
-            if to_end and idx + 1 >= len(s):
-                return "<EOF>"
-            return s[idx]
-
-        correct, wrong = (
-            get_char_or_eof(case.expect_output, i),
-            get_char_or_eof(output_in_memory, i),
-        )
-
-        with open(case.input_doc_path, "r", encoding="utf-8") as input:
-            input_str = input.read()
-
-        output_len = len(output_in_memory)
-
-        msg = (
-            f"{colored('Output mismatch.', 'blue')}\n"
-            f"{colored('Output', 'yellow')} [mismatch in {i}]:\n"
-            f"{output_in_memory[: i - 5]}{colored(output_in_memory[i - 5 : min(i + 5, output_len)], 'red')}"
-            f"{output_in_memory[min(i + 5, output_len) :]}\n"
-            f"{colored('Expect output', 'yellow')}:\n{case.expect_output}\n"
-            f"expect {repr(correct)}, get {repr(wrong)}\n"
-            f"{colored('Input', 'yellow')}:\n{input_str}"
-        )
-
-        return JudgeResult("test", False, msg)
+    if output_in_memory != expect_output:
+        diff = find_mismatch(expect_output, output_in_memory, diff_context)
+        return JudgeResult("test", False, format_diff(diff), diff=diff)
     return JudgeResult("test", True, log)
@@ -0,0 +1,108 @@
+import functools
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from typing import Union
+
+from docman_judge.lookup import default_cache_path
+
+# On Linux, exec() carries the peak memory of the process it replaces over to the program, so the ru_maxrss
+# of a program the judge starts is at least the judge's own peak. Cases are started through this launcher
+# instead, a small C program which forks the case's program, waits for it and writes its ru_maxrss (KiB) to
+# the file descriptor it is given, then exits as the program did. It is built once with the C compiler the
+# workspaces are built with, and kept next to the lookup cache.
+#
+#     docman-judge-launcher FD PROGRAM [ARGS...]
+#
+# SIGTERM makes it SIGKILL the program and report as usual; the program also dies with the launcher.
+
+LAUNCHER_SOURCE = r"""
+#include <errno.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+static volatile pid_t child;
+
+static void kill_child(int sig) {
+    (void)sig;
+    kill(child, SIGKILL);
+}
+
+int main(int argc, char **argv) {
+    if (argc < 3) {
+        fprintf(stderr, "usage: %s FD PROGRAM [ARGS...]\n", argv[0]);
+        return 2;
+    }
+    int fd = atoi(argv[1]);
+    pid_t parent = getpid();
+    sigset_t term, old;
+    sigemptyset(&term);
+    sigaddset(&term, SIGTERM);
+    sigprocmask(SIG_BLOCK, &term, &old);  /* until the handler knows the child */
+    child = fork();
+    if (child < 0) {
+        perror("docman-judge-launcher: fork");
+        return 2;
+    }
+    if (child == 0) {
+        sigprocmask(SIG_SETMASK, &old, NULL);
+        prctl(PR_SET_PDEATHSIG, SIGKILL);
+        if (getppid() != parent) _exit(137);
+        close(fd);
+        execv(argv[2], argv + 2);
+        fprintf(stderr, "docman-judge-launcher: failed to execute %s: %s\n", argv[2], strerror(errno));
+        _exit(127);
+    }
+    signal(SIGTERM, kill_child);
+    sigprocmask(SIG_SETMASK, &old, NULL);
+
+    int status;
+    struct rusage usage;
+    while (wait4(child, &status, 0, &usage) < 0) {
+        if (errno != EINTR) return 2;
+    }
+    dprintf(fd, "%ld\n", usage.ru_maxrss);
+    close(fd);
+    if (WIFSIGNALED(status)) {
+        struct rlimit no_core = {0, 0};
+        setrlimit(RLIMIT_CORE, &no_core);
+        signal(WTERMSIG(status), SIG_DFL);
+        kill(getpid(), WTERMSIG(status));
+    }
+    return WIFEXITED(status) ? WEXITSTATUS(status) : 2;
+}
+"""
+
+
+# The launcher, built if needed; None where it isn't needed (not Linux) or can't be built.
+@functools.lru_cache(maxsize=None)
+def launcher_path() -> Union[None, str]:
+    compiler = shutil.which("cc") or shutil.which("gcc") or shutil.which("clang")
+    if not sys.platform.startswith("linux") or compiler is None:
+        return None
+    digest = hashlib.sha256(LAUNCHER_SOURCE.encode()).hexdigest()[:16]
+    path = default_cache_path().parent / f"launcher-{digest}"
+    if path.exists():
+        return str(path)
+    os.makedirs(path.parent, exist_ok=True)
+    source, tmp_path = Path(f"{path}.{os.getpid()}.c"), Path(f"{path}.{os.getpid()}.tmp")
+    try:
+        source.write_text(LAUNCHER_SOURCE)
+        build = subprocess.run([compiler, "-O2", "-o", str(tmp_path), str(source)], capture_output=True, text=True)
+        if build.returncode != 0:
+            print(f"Could not build the launcher, max_rss is not measured:\n{build.stderr}", file=sys.stderr)
+            return None
+        os.replace(tmp_path, path)  # other judges may be building it too
+    finally:
+        source.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
+    return str(path)
@@ -1,16 +1,23 @@
 import abc
 import json
 import os
-from typing import Callable, List
+from typing import Callable, List, Set, Union
 
 from termcolor import colored
 
-from docman_judge.judge import JudgeResult
+from docman_judge.judge import JudgeResult, format_diff
 
 
 class ILogger(metaclass=abc.ABCMeta):
     @abc.abstractmethod
+    def begin(self, ws_path: str) -> None:
+        pass
+
     def exec_func(self, func: Callable[[str], JudgeResult], ws_path: str) -> bool:
+        return self.log(wrap_exception(func)(ws_path))
+
+    @abc.abstractmethod
+    def log(self, result: JudgeResult) -> bool:
         pass
 
     @abc.abstractmethod
@@ -28,22 +35,71 @@ def wrap_exception(func: Callable[[str], JudgeResult]):
     return wrapped
 
 
+CLEAR_LINE = "\r\033[K"  # back to the start of the line and erase it
+
+
+# In live mode, case results are tallied on a status line redrawn in place, only failures being printed in
+# full; `total` is the number of cases to expect, if known.
 class TermLogger(ILogger):
-    def __init__(self) -> None:
+    def __init__(self, live: bool = False, exit_on_failure: bool = True) -> None:
         self.has_failed = False
+        self.live = live
+        self.exit_on_failure = exit_on_failure
+        self.total: Union[None, int] = None
+        self.counts = {"passed": 0, "failed": 0, "skipped": 0}
+
+    def begin(self, ws_path: str) -> None:
+        self.counts = dict.fromkeys(self.counts, 0)
+        print(f"Judging {ws_path}", flush=True)
+
+    def status(self) -> str:
+        done = sum(self.counts.values())
+        return (
+            f"{done}{'' if self.total is None else f'/{self.total}'} cases: "
+            + colored(f"{self.counts['passed']} passed", "green")
+            + ", "
+            + colored(f"{self.counts['failed']} failed", "red")
+            + f", {self.counts['skipped']} skipped"
+        )
+
+    def log_live(self, result: JudgeResult) -> bool:
+        outcome = "passed" if result.success else "skipped" if result.outcome == "skipped" else "failed"
+        self.counts[outcome] += 1
+        if outcome == "failed":
+            print(CLEAR_LINE + f"[{result.case}]", colored("Failed", "red"))
+            print(self.highlight(result))
+        self.has_failed = self.has_failed or not result.success
+        print(CLEAR_LINE + self.status(), end="", flush=True)
+        return result.success
 
-    def exec_func(self, func: Callable[[str], JudgeResult], ws_path: str) -> bool:
-        result = wrap_exception(func)(ws_path)
-        if result.success:
+    def log(self, result: JudgeResult) -> bool:
+        if self.live:
+            if result.case is not None:
+                return self.log_live(result)
+            print(CLEAR_LINE, end="")
+        if result.title == "usage":
+            print(f"[{result.title}]\n{result.log}", flush=True)
+        elif result.success:
             print(f"[{result.title}]", colored("OK", "green"), flush=True)
+            if result.title == "scaling":
+                print(result.log)
         else:
             print(f"[{result.title}]", colored("Failed", "red"), flush=True)
-            print(result.log)
+            print(self.highlight(result))
             self.has_failed = True
         return result.success
 
+    @staticmethod
+    def highlight(result: JudgeResult) -> str:
+        if result.diff is not None:
+            return format_diff(result.diff, lambda text, color: colored(text, color))
+        reason, _, rest = result.log.partition("\n")
+        return f"{colored(reason, 'blue')}\n{rest}"
+
     def end(self) -> None:
-        if self.has_failed:
+        if self.live and sum(self.counts.values()) > 0:
+            print(CLEAR_LINE + self.status(), flush=True)
+        if self.has_failed and self.exit_on_failure:
             exit(1)
 
 
@@ -53,8 +109,10 @@ class JsonLogger(ILogger):
         self.results: List[JudgeResult] = []
         pass
 
-    def exec_func(self, func: Callable[[str], JudgeResult], ws_path: str) -> bool:
-        result = wrap_exception(func)(ws_path)
+    def begin(self, ws_path: str) -> None:
+        pass
+
+    def log(self, result: JudgeResult) -> bool:
         self.results.append(result)
         return result.success
 
@@ -62,3 +120,80 @@ class JsonLogger(ILogger):
         with open(self.json_path, "a") as f:
             f.write(json.dumps([result.__dict__ for result in self.results]) + "\n")
         self.results = []
+
+
+# Keeps the results of one workspace, e.g. to send them back from a batch worker process.
+class MemoryLogger(ILogger):
+    def __init__(self) -> None:
+        self.results: List[JudgeResult] = []
+
+    def begin(self, ws_path: str) -> None:
+        pass
+
+    def log(self, result: JudgeResult) -> bool:
+        self.results.append(result)
+        return result.success
+
+    def end(self) -> None:
+        pass
+
+
+# Appends one JSON object per line, so a crash loses at most the last `flush_every` records.
+# Each workspace is framed by {"workspace": ..., "begin": true} and {"workspace": ..., "end": true, ...}
+# records; if a workspace appears several times, its records after the last "begin" are the valid ones.
+# The "end" record has "judged": false if the judge failed to judge the workspace, see completed_workspaces().
+class JsonLinesLogger(ILogger):
+    def __init__(self, jsonl_path: str, flush_every: int = 32) -> None:
+        self.jsonl_path = os.path.abspath(jsonl_path)
+        self.flush_every = flush_every
+        self.workspace = None
+        self.success = True
+        self.judged = True
+        self.pending: List[str] = []
+        # Terminate a line left half-written by a crash, so it doesn't swallow the next record.
+        if os.path.exists(self.jsonl_path) and os.path.getsize(self.jsonl_path) > 0:
+            with open(self.jsonl_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.pending.append("")
+
+    def begin(self, ws_path: str) -> None:
+        self.workspace = ws_path
+        self.success = True
+        self.judged = True
+        self.pending.append(json.dumps({"workspace": ws_path, "begin": True}))
+
+    def log(self, result: JudgeResult) -> bool:
+        self.success = self.success and result.success
+        self.judged = self.judged and result.outcome != "judge-error"
+        self.pending.append(json.dumps({"workspace": self.workspace, **result.__dict__}))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+        return result.success
+
+    def end(self) -> None:
+        self.pending.append(
+            json.dumps({"workspace": self.workspace, "end": True, "success": self.success, "judged": self.judged})
+        )
+        self.flush()
+
+    def flush(self) -> None:
+        with open(self.jsonl_path, "a") as f:
+            f.write("".join(line + "\n" for line in self.pending))
+        self.pending = []
+
+
+# Workspaces logged to the end, but not those the judge failed to judge.
+def completed_workspaces(jsonl_path: str) -> Set[str]:
+    completed = set()
+    if not os.path.exists(jsonl_path):
+        return completed
+    with open(jsonl_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:  # cut short by a crash
+                continue
+            if record.get("end") and record.get("judged", True):
+                completed.add(record["workspace"])
+    return completed
@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Set, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from docman_judge.profiling import span
+
+API_ENDPOINT = "http://docman.zhuof.wang"
+
+
+class LookupMiss(Exception):
+    pass
+
+
+def default_cache_path() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(cache_home) / "docman_judge" / "lookup.sqlite3"
+
+
+# Persistent cache of the metadata API: `/isbn/<isbn>` for books, `/title/<url>` for webpages.
+# Responses are stored as decoded JSON, keyed by (kind, key), and refetched after `ttl` seconds. Only answers
+# are stored: a 2xx, or a 404 for a key the API knows nothing of. Other errors are retried, then raised.
+# In offline mode only the cache is consulted, expired entries included.
+class LookupCache:
+    def __init__(
+        self,
+        path: Union[None, str, Path] = None,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 4096,
+        offline: bool = False,
+        endpoint: str = API_ENDPOINT,
+        timeout: float = 10,
+        retries: int = 3,
+    ) -> None:
+        self.path = None if path is None else str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        self.endpoint = endpoint.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.conn = None
+        self.session = None
+        self.pid = None
+
+    def connect(self) -> sqlite3.Connection:
+        # sqlite connections and HTTP sessions must not cross fork(), so every process opens its own ones.
+        if self.conn is None or self.pid != os.getpid():
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            if self.path is None:
+                self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS lookup "
+                "(kind TEXT, key TEXT, payload TEXT, fetched_at REAL, PRIMARY KEY (kind, key))"
+            )
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def load(self, kind: str, key: str) -> Union[None, dict]:
+        with self.lock:
+            row = (
+                self.connect()
+                .execute("SELECT payload, fetched_at FROM lookup WHERE kind = ? AND key = ?", (kind, key))
+                .fetchone()
+            )
+        if row is None or (not self.offline and time.time() - row[1] > self.ttl):
+            return None
+        return json.loads(row[0])
+
+    def store(self, kind: str, key: str, payload: dict) -> None:
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO lookup VALUES (?, ?, ?, ?)", (kind, key, json.dumps(payload), time.time())
+            )
+            # Evict the oldest entries once the cache grows over its limit.
+            conn.execute(
+                "DELETE FROM lookup WHERE rowid IN "
+                "(SELECT rowid FROM lookup ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+
+    def fetch(self, kind: str, key: str) -> dict:
+        url = f"{self.endpoint}/{kind}/{urllib.parse.quote(key, safe='')}"
+        with self.lock:
+            self.connect()
+            session = self.session
+        for attempt in range(self.retries):
+            try:
+                with span("lookup", "network", kind=kind, key=key, attempt=attempt):
+                    result = session.get(url, timeout=self.timeout)
+                if result.status_code != 404:
+                    result.raise_for_status()
+                return json.loads(result.content.decode())
+            except (requests.RequestException, ValueError):
+                if attempt + 1 == self.retries:
+                    raise
+                time.sleep(0.5 * 2**attempt)
+
+    def get(self, kind: str, key: str) -> dict:
+        payload = self.load(kind, key)
+        if payload is not None:
+            return payload
+        if self.offline:
+            raise LookupMiss(f"{kind} {key!r} is not cached, cannot look it up in offline mode.")
+        payload = self.fetch(kind, key)
+        self.store(kind, key, payload)
+        return payload
+
+    def prefetch(self, keys: Iterable[Tuple[str, str]], jobs: int = 8) -> None:
+        if self.offline:
+            return
+        missing = [(kind, key) for kind, key in keys if self.load(kind, key) is None]
+
+        def fetch_one(kind_key: Tuple[str, str]) -> None:
+            try:
+                self.get(*kind_key)
+            except Exception:
+                pass  # The reference solver will retry and report it when it needs this entry.
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(fetch_one, missing))
+
+
+lookup_cache = LookupCache()
+
+
+def set_lookup_cache(cache: LookupCache) -> None:
+    global lookup_cache
+    lookup_cache = cache
+
+
+def lookup(kind: str, key: str) -> dict:
+    return lookup_cache.get(kind, key)
+
+
+# All (kind, key) lookups the citation files in `citation_dir` may need, malformed files skipped.
+def citation_lookup_keys(citation_dir: Union[str, Path]) -> Set[Tuple[str, str]]:
+    keys = set()
+    for filename in os.listdir(citation_dir):
+        keys |= citation_file_lookup_keys(os.path.join(citation_dir, filename))
+    return keys
+
+
+# The (kind, key) lookups the citation file at `citation_path` may need, none if it is malformed.
+def citation_file_lookup_keys(citation_path: Union[str, Path]) -> Set[Tuple[str, str]]:
+    keys = set()
+    try:
+        with open(citation_path, "r") as file:
+            citations = json.load(file)["citations"]
+    except (OSError, ValueError, TypeError, KeyError):
+        return keys
+    if type(citations) is not list:
+        return keys
+    for citation in citations:
+        if type(citation) is not dict:
+            continue
+        if citation.get("type") == "book" and type(citation.get("isbn")) is str:
+            keys.add(("isbn", citation["isbn"]))
+        elif citation.get("type") == "webpage" and type(citation.get("url")) is str:
+            keys.add(("title", citation["url"]))
+    return keys
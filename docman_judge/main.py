@@ -1,75 +1,594 @@
 import argparse
+import hashlib
+import json
 import os
+import random
 import shutil
+import struct
+import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from importlib.resources import files
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import List, Tuple, Union
 
-from docman_judge.cases import generate_random_files, get_cases
-from docman_judge.judge import build
+from docman_judge.answers import AnswerStore
+from docman_judge.bundle import VERSION as BUNDLE_VERSION
+from docman_judge.bundle import BundleError, CaseBundle, default_bundle_cache_dir, pack_bundle
+from docman_judge.cases import (
+    GENERATOR_VERSION,
+    Case,
+    MalformedCase,
+    generate_performance_files,
+    generate_random_files,
+    get_cases,
+    get_performance_cases,
+    parse_size,
+)
+from docman_judge.cluster import (
+    DEFAULT_AUTHKEY,
+    Coordinator,
+    parse_address,
+    resolve_authkey,
+    spawn_workers,
+    worker_main,
+)
+from docman_judge.engine import AsyncExecutor, test_async
+from docman_judge.history import CaseHistory
+from docman_judge.judge import BuildOptions, JudgeResult, ResourceLimits, RunOptions, hash_file, summarize_usage
+from docman_judge.judge import build as build_workspace
 from docman_judge.judge import test as test_by_case
-from docman_judge.log import ILogger, JsonLogger, TermLogger
+from docman_judge.log import ILogger, JsonLinesLogger, JsonLogger, MemoryLogger, TermLogger, completed_workspaces
+from docman_judge.lookup import (
+    API_ENDPOINT,
+    LookupCache,
+    citation_lookup_keys,
+    default_cache_path,
+    set_lookup_cache,
+)
+from docman_judge.metrics import BatchMetrics, MetricsFile, MetricsLogger, serve_metrics
+from docman_judge.pipeline import judge_pipelined
+from docman_judge.profiling import record, span, tracer
+from docman_judge.scaling import ScalingPlan, generate_scaling_plan, geometric_sizes, grade_scaling
+from docman_judge.watch import watch
 
 
-def judge(path: str, input_cases_dir: Path, citation_dir: Path, output_dir: Path, logger: ILogger):
-    if logger.exec_func(build, path):
-        cases = get_cases(input_cases_dir, citation_dir, output_dir)
+@dataclass
+class JudgeOptions:
+    jobs: int = 1
+    build: BuildOptions = field(default_factory=BuildOptions)
+    run: RunOptions = field(default_factory=RunOptions)
+    verbose: bool = True
+    scaling: Union[None, ScalingPlan] = None
+    # Fail-fast mode: stop a workspace after this many failed cases, running the likeliest failures first.
+    max_failures: Union[None, int] = None
+    history: Union[None, CaseHistory] = None
+    profile: bool = False
+
+
+def timed_build(path: str, options: BuildOptions) -> JudgeResult:
+    time_start = time.perf_counter()
+    result = build_workspace(path, options)
+    result.usage = {"wall_time": time.perf_counter() - time_start}
+    return result
+
+
+# Returns the results of the cases. `build_result` is that of a build done beforehand, e.g. by the pipeline.
+def judge(
+    path: str,
+    cases: List[Union[Case, MalformedCase]],
+    logger: ILogger,
+    options: Union[None, JudgeOptions] = None,
+    build_result: Union[None, JudgeResult] = None,
+) -> List[JudgeResult]:
+    if options is None:
+        options = JudgeOptions()
+    path = os.path.abspath(path)
+    logger.begin(path)
+    if options.history is not None:
+        cases = options.history.order(path, cases)
+    results = []
+
+    def build(p: str):
+        return timed_build(p, options.build)
+
+    if logger.exec_func(build, path) if build_result is None else logger.log(build_result):
         num_cases = len(cases)
 
         time_start = time.time()
-        for i, case in enumerate(cases):
-            print(f"Testing {i + 1}/{num_cases} [time escaped: {time.time() - time_start:.2f}s]...")
+        deadline = None if options.run.deadline is None else time.monotonic() + options.run.deadline
+        abort_reason = None
+        consecutive_timeouts = 0
+        failures = 0
+        if options.run.engine == "asyncio":
+            executor, test_case = AsyncExecutor(options.jobs), test_async
+        else:
+            executor, test_case = ThreadPoolExecutor(max_workers=options.jobs), test_by_case
+        with executor:
+            futures = [executor.submit(test_case, path, case, options.run, deadline) for case in cases]
+            # Results are handed to the logger in case order, whatever order they finish in.
+            for i, future in enumerate(futures):
+                if future.cancelled():
+                    result = JudgeResult("test", False, abort_reason, outcome="skipped")
+                else:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = JudgeResult("test", False, str(e))
+                result.case = cases[i].name
+                with span("log", "log"):
+                    logger.log(result)
+                results.append(result)
+                if options.verbose:
+                    print(f"Tested {i + 1}/{num_cases} [time escaped: {time.time() - time_start:.2f}s]...")
+
+                consecutive_timeouts = consecutive_timeouts + 1 if result.outcome == "timeout" else 0
+                failures += not result.success and result.outcome != "skipped"
+                max_timeouts = options.run.max_consecutive_timeouts
+                if abort_reason is None and max_timeouts is not None and consecutive_timeouts >= max_timeouts:
+                    abort_reason = f"Workspace aborted after {consecutive_timeouts} consecutive timeouts, case skipped."
+                elif abort_reason is None and options.max_failures is not None and failures >= options.max_failures:
+                    abort_reason = f"Workspace stopped after {failures} failed cases (fail-fast), case skipped."
+                else:
+                    continue
+                for pending in futures[i + 1 :]:
+                    pending.cancel()
+
+        summary = summarize_usage(results)
+        if summary is not None:
+            logger.log(summary)
 
-            def test(p: str):
-                return test_by_case(p, case)
+        if options.scaling is not None and abort_reason is None:
 
-            logger.exec_func(test, path)
+            def scaling(p: str):
+                return grade_scaling(p, options.scaling, options.run)
+
+            logger.exec_func(scaling, path)
     logger.end()
+    return results
 
 
-def main():
+# Returns the results, and the spans recorded while judging when profiling.
+def judge_in_worker(
+    path: str, cases: List[Union[Case, MalformedCase]], options: JudgeOptions
+) -> Tuple[List[JudgeResult], List[dict]]:
+    if options.profile:
+        tracer.enable()
+    tracer.take()  # spans of the parent, inherited by a forked worker
+    logger = MemoryLogger()
+    judge(path, cases, logger, options)
+    return logger.results, tracer.take()
+
+
+def judge_batch(
+    paths: List[str], cases: List[Union[Case, MalformedCase]], logger: ILogger, workers: int, options: JudgeOptions
+) -> None:
+    if workers <= 1:
+        for path in paths:
+            judge(path, cases, logger, options)
+        return
+
+    # Each workspace is judged in its own process; its results come back as a whole and are
+    # logged one workspace after another, in the order the workspaces were given.
+    worker_options = replace(options, verbose=False)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(judge_in_worker, path, cases, worker_options) for path in paths]
+        for i, (path, future) in enumerate(zip(paths, futures, strict=True)):
+            try:
+                results, events = future.result()
+                tracer.add(events)
+            except Exception as e:
+                results = [JudgeResult("judge", False, str(e), outcome="judge-error")]
+            logger.begin(os.path.abspath(path))
+            for result in results:
+                with span("log", "log"):
+                    logger.log(result)
+            logger.end()
+            print(f"Judged {i + 1}/{len(paths)}: {path}")
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+# Options of the case set, shared by the judge and the `bundle` command.
+def add_case_arguments(parser: argparse.ArgumentParser) -> None:
     buildin_data = files("docman_judge.data")
     buildin_data_inputs = buildin_data / "inputs"
     buildin_data_citations = buildin_data / "citations"
 
-    parser = argparse.ArgumentParser(description="RJSJ Docman Homework Judge Program")
+    parser.add_argument("--input_dir", help="where test cases comes from", default=buildin_data_inputs)
+    parser.add_argument(
+        "--citation_dir", help="where citation for test cases comes from", default=buildin_data_citations
+    )
+    parser.add_argument("--seed", type=int, help="seed of the generated cases, random by default")
+    parser.add_argument("--api", help="endpoint of the ISBN/webpage title API", default=API_ENDPOINT)
+    parser.add_argument("--lookup_cache", help="where API responses are cached", default=default_cache_path())
+    parser.add_argument(
+        "--lookup_ttl", type=float, default=7 * 24 * 3600, help="seconds before a cached API response is refetched"
+    )
+    parser.add_argument("--offline", action="store_true", help="only use cached API responses")
+    parser.add_argument("--lookup_jobs", type=int, default=8, help="number of concurrent API requests")
+    parser.add_argument("--answers", help="a file to keep expected outputs in across runs")
+    parser.add_argument(
+        "--perf_sizes",
+        nargs="+",
+        type=parse_size,
+        default=[],
+        help="add a performance tier with generated articles of these sizes, e.g. 64K 16M 256M",
+    )
+    parser.add_argument("--perf_citations", type=int, default=2000, help="citations per performance article")
+    parser.add_argument(
+        "--perf_nesting", type=int, default=100000, help="bracket depth of the nested performance article, 0 for none"
+    )
+
+
+# Generates the case set in `tmpdir` and computes its expected outputs.
+def prepare_cases(args: argparse.Namespace, tmpdir: Path) -> List[Union[Case, MalformedCase]]:
+    assert os.path.isdir(args.input_dir) and os.path.isdir(args.citation_dir)
+    lookup_cache = LookupCache(args.lookup_cache, ttl=args.lookup_ttl, offline=args.offline, endpoint=args.api)
+    set_lookup_cache(lookup_cache)
+
+    tmp_input_dir = tmpdir / "inputs"
+    tmp_citation_dir = tmpdir / "citations"
+    shutil.copytree(args.input_dir, tmp_input_dir)
+    shutil.copytree(args.citation_dir, tmp_citation_dir)
+
+    with span("generate_random_files", "generate"):
+        generate_random_files(tmp_input_dir, tmp_citation_dir, args.seed)
+    citation_dirs = [tmp_citation_dir]
+    if args.perf_sizes:
+        perf_input_dir, perf_citation_dir = tmpdir / "perf_inputs", tmpdir / "perf_citations"
+        perf_input_dir.mkdir()
+        perf_citation_dir.mkdir()
+        with span("generate_performance_files", "generate"):
+            generate_performance_files(
+                perf_input_dir, perf_citation_dir, args.perf_sizes, args.perf_citations, args.perf_nesting, args.seed
+            )
+        citation_dirs.append(perf_citation_dir)
+
+    # Resolve every remote citation up front, so the reference solver only reads from the cache.
+    lookup_keys = set().union(*(citation_lookup_keys(citation_dir) for citation_dir in citation_dirs))
+    with span("prefetch", "lookup", keys=len(lookup_keys)):
+        lookup_cache.prefetch(lookup_keys, args.lookup_jobs)
+
+    # Expected outputs are computed once and shared by every workspace.
+    answers = AnswerStore(args.answers)
+    with span("answers", "reference"):
+        cases = get_cases(tmp_input_dir, tmp_citation_dir, answers)
+        if args.perf_sizes:
+            perf_expected_dir = tmpdir / "perf_expected"
+            perf_expected_dir.mkdir()
+            cases += get_performance_cases(perf_input_dir, perf_citation_dir, perf_expected_dir)
+    answers.save()
+    return cases
+
+
+# Identifies the case set prepare_cases() generates: the same key means the same inputs and answers.
+def case_set_key(args: argparse.Namespace) -> str:
+    params = {
+        "generator": GENERATOR_VERSION,
+        "bundle": BUNDLE_VERSION,
+        "seed": args.seed,
+        "api": args.api,
+        "perf_sizes": args.perf_sizes,
+        "perf_citations": args.perf_citations,
+        "perf_nesting": args.perf_nesting,
+    }
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    for directory in (args.input_dir, args.citation_dir):
+        for filename in sorted(os.listdir(directory)):
+            digest.update(filename.encode() + b"\0")
+            digest.update(hash_file(os.path.join(directory, filename)).encode())
+    return digest.hexdigest()[:16]
+
+
+# With a seed, the generated case set is kept as a bundle under `args.case_cache`, keyed by the seed and the
+# generation options, so later runs and concurrent judges with the same options load it instead.
+# Returns the cases and the bundle they are kept in, if any.
+def load_cases(args: argparse.Namespace, tmpdir: Path) -> Tuple[List[Union[Case, MalformedCase]], Union[None, Path]]:
+    if not args.case_cache:
+        return prepare_cases(args, tmpdir), None
+    bundle_path = Path(args.case_cache) / f"seed{args.seed}-{case_set_key(args)}.bundle"
+    if bundle_path.is_file():
+        try:
+            return CaseBundle(bundle_path, tmpdir / "bundle").cases(), bundle_path
+        except (BundleError, ValueError, struct.error) as e:
+            print(f"Ignoring the broken cached case set {bundle_path}: {e}")
+    cases = prepare_cases(args, tmpdir)
+    bundle_path.parent.mkdir(parents=True, exist_ok=True)
+    pack_bundle(bundle_path, tmpdir, cases)
+    return cases, bundle_path
+
+
+# `docman-judge bundle OUT`: packs the case set once, for later runs to load with `--bundle OUT`.
+def bundle_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="docman-judge bundle", description="Pack the Docman test cases in a file")
+    parser.add_argument("output", help="where to write the bundle")
+    add_case_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with TemporaryDirectory() as tmpdir:
+        cases = prepare_cases(args, Path(tmpdir))
+        pack_bundle(args.output, Path(tmpdir), cases)
+    print(f"Packed {len(cases)} cases into {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+def serve(
+    args: argparse.Namespace,
+    workspaces: List[str],
+    cases: List[Union[Case, MalformedCase]],
+    bundle_path: Union[None, Path],
+    tmpdir: Path,
+    logger: ILogger,
+    options: JudgeOptions,
+) -> None:
+    if options.scaling is not None:
+        print("Scaling grades are not distributed, --scaling is ignored with --serve.")
+        options = replace(options, scaling=None)
+    with TemporaryDirectory() as served_dir:
+        if bundle_path is None:
+            bundle_path = Path(served_dir) / "cases.bundle"
+            pack_bundle(bundle_path, tmpdir, cases)
+        coordinator = Coordinator(
+            parse_address(args.serve),
+            args.authkey,
+            workspaces,
+            bundle_path,
+            options,
+            args.max_attempts,
+            args.worker_timeout,
+        )
+        workers = spawn_workers(coordinator.address, args.authkey, args.spawn_workers)
+        try:
+            coordinator.run(logger, workers)
+        finally:
+            for worker in workers:
+                worker.wait()
+
+
+def main():
+    if sys.argv[1:2] == ["bundle"]:
+        return bundle_main(sys.argv[2:])
+    if sys.argv[1:2] == ["worker"]:
+        return worker_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description="RJSJ Docman Homework Judge Program",
+        epilog="Run `docman-judge bundle -h` to pack the test cases, `docman-judge worker -h` to judge for a coordinator.",
+    )
     parser.add_argument("workspaces", nargs="*", help="workspace path")
     parser.add_argument("--batch", dest="batch_file", help="a file containing a list of workspace paths")
     parser.add_argument("--log", dest="log_file", help="a file to save the judge result")
-    parser.add_argument("--input_dir", help="where test cases comes from", default=buildin_data_inputs)
     parser.add_argument(
-        "--citation_dir", help="where citation for test cases comes from", default=buildin_data_citations
+        "--log_format",
+        choices=["json", "jsonl"],
+        default="json",
+        help="json: one array per workspace; jsonl: one record per result, written as judging goes",
+    )
+    parser.add_argument("--resume", action="store_true", help="skip workspaces already completed in the jsonl log file")
+    parser.add_argument(
+        "--watch", action="store_true", help="judge the workspace again every time its sources change, until Ctrl-C"
+    )
+    parser.add_argument("--watch_interval", type=float, default=0.5, help="seconds between checks for changes")
+    parser.add_argument(
+        "--fail_fast",
+        type=int,
+        metavar="N",
+        help="stop a workspace after N failed cases, running first the cases likeliest to fail and the cheapest",
+    )
+    parser.add_argument(
+        "--history", help="jsonl log of previous runs to order cases by with --fail_fast, the jsonl --log by default"
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=os.cpu_count() or 1, help="number of test cases run concurrently"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="number of workspaces judged concurrently")
+    parser.add_argument("--pipeline", action="store_true", help="build the next workspaces while the cases of one run")
+    parser.add_argument("--build_workers", type=int, default=1, help="with --pipeline, workspaces built at once")
+    parser.add_argument(
+        "--max_ahead", type=int, default=2, help="with --pipeline, workspaces built or building ahead of the tests"
+    )
+    parser.add_argument("--serve", metavar="HOST:PORT", help="hand the workspaces out to `docman-judge worker`s")
+    parser.add_argument(
+        "--authkey",
+        default=DEFAULT_AUTHKEY,
+        help="with --serve, shared secret, $DOCMAN_JUDGE_AUTHKEY by default; required unless HOST is loopback",
+    )
+    parser.add_argument("--spawn_workers", type=int, default=0, help="with --serve, start this many local workers")
+    parser.add_argument("--max_attempts", type=int, default=3, help="with --serve, times a workspace is tried")
+    parser.add_argument(
+        "--worker_timeout", type=float, default=600, help="with --serve, seconds of silence before a worker is lost"
+    )
+    parser.add_argument("--metrics_file", help="a Prometheus text file rewritten with the progress of the run")
+    parser.add_argument("--metrics_interval", type=float, default=15, help="seconds between rewrites of --metrics_file")
+    parser.add_argument("--metrics_port", type=int, help="serve the metrics on http://127.0.0.1:PORT/metrics")
+    add_case_arguments(parser)
+    parser.add_argument("--bundle", help="load the test cases from a file made by `docman-judge bundle`")
+    parser.add_argument(
+        "--case_cache",
+        default=default_bundle_cache_dir(),
+        help="where case sets generated with --seed are kept for later runs, empty to disable",
+    )
+    parser.add_argument(
+        "--scaling",
+        nargs=2,
+        type=parse_size,
+        metavar=("MIN", "MAX"),
+        help="grade how the running time grows on generated articles from MIN to MAX bytes, e.g. 64K 16M",
+    )
+    parser.add_argument("--scaling_factor", type=int, default=4, help="ratio between consecutive scaling sizes")
+    parser.add_argument("--scaling_repeats", type=int, default=3, help="runs per scaling size, the fastest counts")
+    parser.add_argument(
+        "--scaling_tolerance",
+        type=float,
+        default=0.3,
+        help="how much steeper than linear (or the reference) the growth exponent may be",
+    )
+    parser.add_argument(
+        "--build_jobs", type=int, default=os.cpu_count() or 1, help="number of parallel compile jobs per workspace"
+    )
+    parser.add_argument("--ccache", action="store_true", help="compile through ccache when it is installed")
+    parser.add_argument("--rebuild", action="store_true", help="build even if the sources didn't change")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds every case gets")
+    parser.add_argument(
+        "--timeout_per_mib",
+        type=float,
+        help="extra seconds a case gets per MiB of input, calibrated on this host by default",
+    )
+    parser.add_argument(
+        "--timeout_per_lookup",
+        type=float,
+        default=5,
+        help="extra seconds a case gets per ISBN or URL the program looks up over the network",
+    )
+    parser.add_argument(
+        "--quick_timeout", type=float, default=5, help="seconds for cases with malformed arguments or missing files"
+    )
+    parser.add_argument("--max_timeout", type=float, default=600, help="upper bound of the timeout of a case")
+    parser.add_argument("--deadline", type=float, help="seconds for all the cases of a workspace")
+    parser.add_argument(
+        "--max_consecutive_timeouts", type=int, help="abort a workspace after this many timeouts in a row"
+    )
+    parser.add_argument(
+        "--output_limit",
+        type=int,
+        default=64 << 20,
+        help="bytes a case may print beyond its expected answer before it is killed, 0 for no limit",
+    )
+    parser.add_argument("--memory_limit", type=parse_size, help="address space a case may use, e.g. 512M")
+    parser.add_argument("--cpu_limit", type=int, help="CPU seconds a case may use")
+    parser.add_argument("--file_size_limit", type=parse_size, help="size of the largest file a case may write")
+    parser.add_argument(
+        "--process_limit",
+        type=int,
+        help="processes and threads the judging user may have in all, the judge's own included, while a case runs: "
+        "only stops runaway forking (not for root)",
+    )
+    parser.add_argument(
+        "--diff_context", type=int, default=100, help="characters shown around the first difference of a mismatch"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="threads: a thread per running case; asyncio: every case of a workspace on one event loop",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="record where the judge spends its time, as a Chrome/Perfetto trace JSON, and print a summary",
     )
 
     args = parser.parse_args()
-    assert os.path.isdir(args.input_dir) and os.path.isdir(args.citation_dir)
+    limits = ResourceLimits(args.memory_limit, args.cpu_limit, args.file_size_limit, args.process_limit)
+    try:
+        limits.check()
+    except ValueError as e:
+        parser.error(str(e))
+    if args.serve:
+        try:
+            args.authkey = resolve_authkey(parse_address(args.serve), args.authkey)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.profile:
+        record(args.profile)
 
-    if args.log_file:
+    assert not args.resume or (args.log_file and args.log_format == "jsonl"), "--resume needs a jsonl log file"
+    if args.log_file and args.log_format == "jsonl":
+        logger = JsonLinesLogger(args.log_file)
+    elif args.log_file:
         logger = JsonLogger(args.log_file)
     else:
         logger = TermLogger()
+    metrics = None
+    if args.metrics_file or args.metrics_port is not None:
+        metrics = BatchMetrics()
+        logger = MetricsLogger(logger, metrics)
+        if args.metrics_file:
+            MetricsFile(metrics, args.metrics_file, args.metrics_interval).start()
+        if args.metrics_port is not None:
+            serve_metrics(metrics, args.metrics_port)
 
     with TemporaryDirectory() as tmpdir:
         tmpdir = Path(tmpdir)
-        tmp_input_dir = tmpdir / "inputs"
-        tmp_citation_dir = tmpdir / "citations"
-        tmp_output_dir = tmpdir / "outputs"
-
-        shutil.copytree(args.input_dir, tmp_input_dir)
-        shutil.copytree(args.citation_dir, tmp_citation_dir)
-        tmp_output_dir.mkdir(parents=True, exist_ok=True)
+        if args.bundle:
+            cases, bundle_path = CaseBundle(args.bundle, tmpdir / "bundle").cases(), Path(args.bundle)
+        elif args.seed is None:
+            args.seed = random.SystemRandom().randrange(1 << 32)
+            print(f"Generating cases with seed {args.seed}, pass --seed {args.seed} to reproduce them.")
+            cases, bundle_path = prepare_cases(args, tmpdir), None
+        else:
+            cases, bundle_path = load_cases(args, tmpdir)
 
-        generate_random_files(tmp_input_dir, tmp_citation_dir)
+        scaling = None
+        if args.scaling:
+            scaling_input_dir, scaling_citation_dir = tmpdir / "scaling_inputs", tmpdir / "scaling_citations"
+            scaling_expected_dir = tmpdir / "scaling_expected"
+            scaling_input_dir.mkdir()
+            scaling_citation_dir.mkdir()
+            scaling_expected_dir.mkdir()
+            scaling = generate_scaling_plan(
+                scaling_input_dir,
+                scaling_citation_dir,
+                scaling_expected_dir,
+                geometric_sizes(*args.scaling, args.scaling_factor),
+                args.perf_citations,
+                args.scaling_repeats,
+                args.scaling_tolerance,
+            )
 
         if args.batch_file:
-            assert os.path.isfile(args.batch)
+            assert os.path.isfile(args.batch_file)
             with open(args.batch_file, "r") as f:
-                for line in f:
-                    judge(line.strip(), tmp_input_dir, tmp_citation_dir, tmp_output_dir, logger)
+                workspaces = [line.strip() for line in f if line.strip()]
+        else:
+            workspaces = args.workspaces
+        if args.resume:
+            completed = completed_workspaces(args.log_file)
+            workspaces = [path for path in workspaces if os.path.abspath(path) not in completed]
+        if metrics is not None:
+            metrics.workspaces = len(workspaces)
+
+        run_options = RunOptions(
+            timeout=args.timeout,
+            timeout_per_mib=0 if args.timeout_per_mib is None else args.timeout_per_mib,
+            timeout_per_lookup=args.timeout_per_lookup,
+            quick_timeout=args.quick_timeout,
+            max_timeout=args.max_timeout,
+            deadline=args.deadline,
+            max_consecutive_timeouts=args.max_consecutive_timeouts,
+            output_limit=args.output_limit or None,
+            diff_context=args.diff_context,
+            engine=args.engine,
+            limits=limits,
+        )
+        if args.timeout_per_mib is None:
+            run_options.calibrate()
+        history = None
+        if args.fail_fast is not None:
+            history_path = args.history or (args.log_file if args.log_format == "jsonl" else None)
+            history = CaseHistory() if history_path is None else CaseHistory.from_jsonl(history_path)
+        options = JudgeOptions(
+            args.jobs,
+            BuildOptions(args.build_jobs, args.ccache, not args.rebuild),
+            run_options,
+            scaling=scaling,
+            max_failures=args.fail_fast,
+            history=history,
+            profile=args.profile is not None,
+        )
+        if args.watch:
+            assert len(workspaces) == 1, "--watch needs exactly one workspace"
+            watch(workspaces[0], cases, replace(options, verbose=False), args.watch_interval)
+        elif args.serve:
+            serve(args, workspaces, cases, bundle_path, tmpdir, logger, options)
+        elif args.pipeline:
+            assert args.workers <= 1, "--pipeline tests one workspace at a time, use --jobs for the cases"
+            judge_pipelined(workspaces, cases, logger, options, args.build_workers, args.max_ahead)
         else:
-            for arg in args.workspaces:
-                judge(arg, tmp_input_dir, tmp_citation_dir, tmp_output_dir, logger)
+            judge_batch(workspaces, cases, logger, args.workers, options)
 
 
 if __name__ == "__main__":
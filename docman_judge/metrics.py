@@ -0,0 +1,226 @@
+import atexit
+import collections
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Tuple, Union
+
+from docman_judge.judge import JudgeResult
+from docman_judge.log import ILogger
+
+# Progress of a long batch run in the Prometheus text format, rewritten to a file every few seconds (e.g. for
+# the textfile collector of node_exporter) or served on localhost:
+#
+#     docman-judge --batch workspaces.txt --log log.jsonl --log_format jsonl --metrics_port 9464
+#     curl localhost:9464/metrics
+#
+# A batch that stalls shows as docman_judge_last_result_timestamp_seconds no longer moving; one that slows down
+# as a falling docman_judge_cases_per_second or a shifting docman_judge_case_latency_seconds.
+
+CASE_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUILD_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)
+RATE_WINDOW = 60  # seconds of cases docman_judge_cases_per_second is averaged over
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped, strict=True)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # cumulative, as exposed
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self, name: str) -> List[str]:
+        lines = [
+            f'{name}_bucket{{le="{bound:g}"}} {count}' for bound, count in zip(self.buckets, self.counts, strict=True)
+        ]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:.6f}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class BatchMetrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.workspaces = 0  # to judge in this run
+        self.workspaces_done: Dict[str, int] = collections.Counter()  # by "passed" / "failed"
+        self.cases: Dict[str, int] = collections.Counter()  # by "passed" / "failed" / "skipped"
+        self.outcomes: Dict[str, int] = collections.Counter()  # timeouts, limits, ...
+        self.failures: Dict[str, int] = collections.Counter()  # by JudgeResult.title
+        self.case_latency = Histogram(CASE_LATENCY_BUCKETS)
+        self.build_duration = Histogram(BUILD_DURATION_BUCKETS)
+        self.recent_cases: Deque[float] = collections.deque()  # time.monotonic() of the cases of the last minute
+        self.last_result: Union[None, float] = None
+
+    def observe(self, result: JudgeResult) -> None:
+        with self.lock:
+            self.last_result = time.time()
+            if not result.success and result.outcome != "skipped":
+                self.failures[result.title] += 1
+            if result.outcome is not None:
+                self.outcomes[result.outcome] += 1
+            wall_time = (result.usage or {}).get("wall_time")
+            if result.title == "build" and wall_time is not None:
+                self.build_duration.observe(wall_time)
+            if result.case is None:
+                return
+            self.cases["passed" if result.success else "skipped" if result.outcome == "skipped" else "failed"] += 1
+            self.recent_cases.append(time.monotonic())
+            if wall_time is not None:
+                self.case_latency.observe(wall_time)
+
+    def workspace_done(self, success: bool) -> None:
+        with self.lock:
+            self.workspaces_done["passed" if success else "failed"] += 1
+
+    def cases_per_second(self) -> float:
+        now = time.monotonic()
+        while len(self.recent_cases) > 0 and self.recent_cases[0] < now - RATE_WINDOW:
+            self.recent_cases.popleft()
+        return len(self.recent_cases) / min(RATE_WINDOW, max(time.time() - self.start_time, 1e-3))
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples: Dict[str, Union[int, float]], label: str = ""):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for value, sample in samples.items():
+                lines.append(f"{name}{format_labels({label: value} if label else {})} {sample}")
+
+        with self.lock:
+            done = sum(self.workspaces_done.values())
+            metric("docman_judge_start_time_seconds", "gauge", "Start of the run.", {"": self.start_time})
+            metric("docman_judge_workspaces", "gauge", "Workspaces to judge in this run.", {"": self.workspaces})
+            metric(
+                "docman_judge_workspaces_pending",
+                "gauge",
+                "Workspaces not judged yet.",
+                {"": max(0, self.workspaces - done)},
+            )
+            metric(
+                "docman_judge_workspaces_done_total",
+                "counter",
+                "Workspaces judged, by result.",
+                {result: self.workspaces_done[result] for result in ("passed", "failed")},
+                "result",
+            )
+            metric(
+                "docman_judge_cases_total",
+                "counter",
+                "Cases judged, by result.",
+                {result: self.cases[result] for result in ("passed", "failed", "skipped")},
+                "result",
+            )
+            metric(
+                "docman_judge_cases_per_second",
+                "gauge",
+                f"Cases judged per second over the last {RATE_WINDOW}s.",
+                {"": f"{self.cases_per_second():.3f}"},
+            )
+            metric(
+                "docman_judge_outcomes_total",
+                "counter",
+                "Results by outcome: timeouts, limits exceeded, skipped cases.",
+                dict(self.outcomes),
+                "outcome",
+            )
+            metric("docman_judge_failures_total", "counter", "Failed results, by title.", dict(self.failures), "title")
+            lines.append("# HELP docman_judge_case_latency_seconds Wall time of a case.")
+            lines.append("# TYPE docman_judge_case_latency_seconds histogram")
+            lines.extend(self.case_latency.render("docman_judge_case_latency_seconds"))
+            lines.append("# HELP docman_judge_build_duration_seconds Wall time of a workspace build.")
+            lines.append("# TYPE docman_judge_build_duration_seconds histogram")
+            lines.extend(self.build_duration.render("docman_judge_build_duration_seconds"))
+            if self.last_result is not None:
+                metric(
+                    "docman_judge_last_result_timestamp_seconds",
+                    "gauge",
+                    "When the last result was logged.",
+                    {"": self.last_result},
+                )
+        return "\n".join(lines) + "\n"
+
+
+# Counts what goes through to `logger`.
+class MetricsLogger(ILogger):
+    def __init__(self, logger: ILogger, metrics: BatchMetrics) -> None:
+        self.logger = logger
+        self.metrics = metrics
+        self.success = True
+
+    def begin(self, ws_path: str) -> None:
+        self.success = True
+        self.logger.begin(ws_path)
+
+    def log(self, result: JudgeResult) -> bool:
+        self.metrics.observe(result)
+        self.success = self.success and result.success
+        return self.logger.log(result)
+
+    def end(self) -> None:
+        self.metrics.workspace_done(self.success)  # before a TermLogger exits on failure
+        self.logger.end()
+
+
+# Rewrites `path` every `interval` seconds and on exit, atomically so a collector never reads half a file.
+class MetricsFile:
+    def __init__(self, metrics: BatchMetrics, path: str, interval: float = 15) -> None:
+        self.metrics = metrics
+        self.path = os.path.abspath(path)
+        self.interval = interval
+
+    def write(self) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.metrics.render())
+        os.replace(tmp_path, self.path)
+
+    def run(self) -> None:
+        while True:
+            self.write()
+            time.sleep(self.interval)
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.write)
+
+
+# Serves the metrics on http://127.0.0.1:`port`/metrics from a background thread.
+def serve_metrics(metrics: BatchMetrics, port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass  # keep the judge's output readable
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics", flush=True)
+    return server
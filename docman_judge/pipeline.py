@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Tuple, Union
+
+from docman_judge.cases import Case, MalformedCase
+from docman_judge.judge import JudgeResult
+from docman_judge.log import ILogger
+
+if TYPE_CHECKING:
+    from docman_judge.main import JudgeOptions
+
+# Judging a batch as a two-stage pipeline: a pool of `build_workers` threads builds the workspaces, in order,
+# while the test stage runs the cases of the workspace built before, `options.jobs` at a time, and logs the
+# workspaces in order. At most `max_ahead` workspaces are built or building ahead of the test stage, so builds
+# wait for a slow test stage instead of piling up.
+
+
+@dataclass
+class StageStats:
+    workers: int
+    busy: float = 0  # seconds, summed over the workers
+    waiting: float = 0  # seconds the stage was held up: for a slot to build, or for a build to test
+
+    def utilisation(self, elapsed: float) -> float:
+        return self.busy / (self.workers * elapsed) if elapsed > 0 else 0
+
+
+def format_report(
+    workspaces: int, elapsed: float, build: StageStats, test: StageStats, cases: StageStats, tested: float
+) -> str:
+    return "\n".join(
+        [
+            f"[pipeline] {workspaces} workspaces in {elapsed:.1f}s",
+            f"build: {build.workers} workers, {build.utilisation(elapsed):.0%} busy, "
+            f"{build.waiting:.1f}s held back by the test stage",
+            f"test: {test.utilisation(elapsed):.0%} busy, {test.waiting:.1f}s waiting for builds",
+            f"cases: {cases.workers} jobs, {cases.utilisation(tested):.0%} busy while testing",
+        ]
+    )
+
+
+# Like judge_batch() with one worker: same results, logged in the same order.
+def judge_pipelined(
+    paths: List[str],
+    cases: List[Union[Case, MalformedCase]],
+    logger: ILogger,
+    options: "JudgeOptions",
+    build_workers: int = 1,
+    max_ahead: int = 2,
+) -> None:
+    from docman_judge.main import judge, timed_build  # main imports this module for its --pipeline option
+
+    build_stats, test_stats, case_stats = StageStats(build_workers), StageStats(1), StageStats(options.jobs)
+    ready: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+    slots = threading.Semaphore(max(1, max_ahead))
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=build_workers)
+
+    def build(path: str) -> JudgeResult:
+        try:
+            return timed_build(path, options.build)
+        except Exception as e:
+            return JudgeResult("build", False, str(e))
+
+    def feed() -> None:
+        for path in paths:
+            wait_start = time.perf_counter()
+            while not slots.acquire(timeout=0.5):
+                if stop.is_set():
+                    return
+            build_stats.waiting += time.perf_counter() - wait_start
+            try:
+                ready.put((path, executor.submit(build, path)))
+            except RuntimeError:  # shut down, the test stage is gone
+                return
+
+    time_start = time.perf_counter()
+    judged = 0
+    threading.Thread(target=feed, daemon=True).start()
+    try:
+        for path in paths:
+            wait_start = time.perf_counter()
+            _, future = ready.get()
+            build_result = future.result()
+            test_stats.waiting += time.perf_counter() - wait_start
+            slots.release()
+            build_stats.busy += (build_result.usage or {}).get("wall_time", 0)
+
+            test_start = time.perf_counter()
+            try:  # a TermLogger exits after a failed workspace
+                results = judge(path, cases, logger, options, build_result)
+            finally:
+                test_stats.busy += time.perf_counter() - test_start
+                judged += 1
+            case_stats.busy += sum((result.usage or {}).get("wall_time", 0) for result in results)
+            print(f"Judged {judged}/{len(paths)}: {path}", flush=True)
+    finally:
+        stop.set()
+        executor.shutdown(cancel_futures=True)
+        elapsed = time.perf_counter() - time_start
+        print(format_report(judged, elapsed, build_stats, test_stats, case_stats, test_stats.busy), flush=True)
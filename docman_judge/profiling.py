@@ -0,0 +1,98 @@
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+# Spans of what the judge spends its time on, recorded when --profile is given and written as a Chrome trace
+# (open it in https://ui.perfetto.dev or chrome://tracing), with a summary table per span name.
+# Recording is off by default and a disabled span costs next to nothing.
+
+
+# The trace track of a span: its thread, or its task for the cases run concurrently by an event loop.
+def track() -> int:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:  # no event loop running in this thread
+        task = None
+    return threading.get_native_id() if task is None else id(task)
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: List[dict] = []
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "judge", **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            # list.append is atomic, so spans of concurrent cases need no lock.
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": track(),
+                    "args": args,
+                }
+            )
+
+    # Hands over the spans recorded so far, e.g. to send them back from a batch worker process.
+    def take(self) -> List[dict]:
+        events, self.events = self.events, []
+        return events
+
+    def add(self, events: List[dict]) -> None:
+        self.events.extend(events)
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self) -> str:
+        spans: Dict[str, List[float]] = {}
+        for event in self.events:
+            spans.setdefault(event["name"], []).append(event["dur"] / 1e6)
+        lines = [f"{'span':<28}{'count':>8}{'total':>12}{'mean':>12}{'max':>12}"]
+        for name, durations in sorted(spans.items(), key=lambda item: -sum(item[1])):
+            lines.append(
+                f"{name:<28}{len(durations):>8}{sum(durations):>12.3f}"
+                f"{sum(durations) / len(durations):>12.4f}{max(durations):>12.4f}"
+            )
+        lines.append("(seconds; spans overlap when nested or concurrent, so totals don't add up to the run time)")
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def span(name: str, category: str = "judge", **args):
+    return tracer.span(name, category, **args)
+
+
+def finish(path: str) -> None:
+    tracer.write(path)
+    print(tracer.summary())
+    print(f"Trace of {len(tracer.events)} spans written to {path}.")
+
+
+# Records spans from now on and writes them to `path` when the judge exits, however it exits.
+def record(path: str) -> None:
+    tracer.enable()
+    atexit.register(finish, path)
@@ -0,0 +1,171 @@
+import math
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Union
+
+from docman_judge.cases import Case, MalformedCase, format_size, generate_stress_file
+from docman_judge.correct import write_expected_output
+from docman_judge.judge import JudgeResult, RunOptions, test
+
+# Grades how the running time of a workspace grows with the input size: the program runs on a geometric
+# series of generated articles, the growth exponent of its CPU time is fitted on a log-log scale and compared
+# with the reference solver, so an O(n^2) bracket matcher no longer passes just because it beats the timeout.
+
+# Below this many seconds (fixed costs excluded), or half the fixed costs, whose jitter it would be lost in,
+# a run is mostly noise and isn't used to fit the growth.
+MIN_MEASURABLE_TIME = 0.005
+# Size of the article timed for the fixed costs of a run.
+BASELINE_SIZE = 256
+
+
+@dataclass
+class ScalingPoint:
+    size: int
+    case: Case
+    reference_time: float  # CPU seconds of the reference solver, in process
+
+
+@dataclass
+class ScalingPlan:
+    baseline: Union[None, ScalingPoint] = None  # a tiny article with the same citations
+    points: List[ScalingPoint] = field(default_factory=list)
+    repeats: int = 3  # runs per point, the fastest one counts
+    tolerance: float = 0.3  # how much steeper than the reference (or linear) the growth may be
+
+
+def geometric_sizes(min_size: int, max_size: int, factor: int = 4) -> List[int]:
+    assert 0 < min_size <= max_size and factor > 1
+    sizes = [min_size]
+    while sizes[-1] * factor <= max_size:
+        sizes.append(sizes[-1] * factor)
+    return sizes
+
+
+# Generates one article per size, all from the same seed and without books or webpages, so the timings
+# don't depend on the metadata API. The reference solver is timed as it streams the expected outputs to
+# `expected_dir`. A tiny article citing the same file gives the fixed costs (startup, reading citations)
+# to subtract.
+def generate_scaling_plan(
+    input_dir: Path,
+    citation_dir: Path,
+    expected_dir: Path,
+    sizes: List[int],
+    num_citations: int = 2000,
+    repeats: int = 3,
+    tolerance: float = 0.3,
+    seed: int = 0,
+) -> ScalingPlan:
+    plan = ScalingPlan(repeats=repeats, tolerance=tolerance)
+    for i, size in enumerate([BASELINE_SIZE, *sizes]):
+        name = "scaling_baseline" if i == 0 else f"scaling_{format_size(size)}"
+        generate_stress_file(input_dir, citation_dir, name, size, num_citations, seed=seed, remote_ratio=0)
+        input_path, citation_path = input_dir / f"{name}.txt", citation_dir / f"{name}.txt"
+        expected_path = expected_dir / f"{name}.txt"
+        reference_time = math.inf
+        for _ in range(repeats):
+            time_start = time.process_time()
+            success = write_expected_output(input_path, citation_path, expected_path)
+            reference_time = min(reference_time, time.process_time() - time_start)
+        expect_path = expected_path if success else None
+        case = Case(input_path, False, citation_path, None, None, not success, f"{name}.txt:scaling", expect_path)
+        point = ScalingPoint(size, case, reference_time)
+        if i == 0:
+            plan.baseline = point
+        else:
+            plan.points.append(point)
+    return plan
+
+
+# Least-squares slope of log(time) over log(size), None with fewer than two usable points.
+def fit_exponent(sizes: List[int], times: List[float]) -> Union[None, float]:
+    points = [(math.log(size), math.log(t)) for size, t in zip(sizes, times, strict=True) if t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def cpu_time(result: JudgeResult) -> float:
+    usage = result.usage or {}
+    if "user_time" in usage:
+        return usage["user_time"] + usage.get("sys_time", 0)
+    return usage.get("wall_time", 0)
+
+
+# Fastest CPU time of `repeats` runs of `case`, or the failed result if one of them fails.
+def best_time(
+    path: str, case: Union[Case, MalformedCase], repeats: int, options: RunOptions
+) -> Union[float, JudgeResult]:
+    best = math.inf
+    for _ in range(repeats):
+        result = test(path, case, options)
+        if isinstance(case, Case) and not result.success:
+            return result
+        best = min(best, cpu_time(result))
+    return best
+
+
+def grade_scaling(path: str, plan: ScalingPlan, options: Union[None, RunOptions] = None) -> JudgeResult:
+    if options is None:
+        options = RunOptions()
+    # Without a baseline, the fixed costs are at least those of a run the program must reject right away.
+    baseline = plan.baseline.case if plan.baseline is not None else MalformedCase([])
+    reference_overhead = plan.baseline.reference_time if plan.baseline is not None else 0
+    overhead = best_time(path, baseline, plan.repeats, options)
+    if isinstance(overhead, JudgeResult):
+        return JudgeResult("scaling", False, f"failed on the baseline article: {overhead.log}")
+
+    sizes, reference_times, times = [], [], []
+    failure = None
+    for point in plan.points:
+        best = best_time(path, point.case, plan.repeats, options)
+        if isinstance(best, JudgeResult):
+            reason = "timed out" if best.outcome == "timeout" else "failed"
+            failure = f"{reason} at {format_size(point.size)}: {best.log.splitlines()[0] if best.log else ''}"
+            break
+        sizes.append(point.size)
+        reference_times.append(max(point.reference_time - reference_overhead, 0))
+        times.append(max(best - overhead, 0))
+
+    lines = [f"{'size':>8}{'reference':>12}{'program':>12}{'slope':>8}"]
+    measurable = [i for i, t in enumerate(times) if t >= max(MIN_MEASURABLE_TIME, overhead / 2)]
+    slopes = {}
+    for i, j in zip(measurable, measurable[1:], strict=False):
+        slopes[j] = math.log(times[j] / times[i]) / math.log(sizes[j] / sizes[i])
+    for i, size in enumerate(sizes):
+        slope = f"{slopes[i]:>8.2f}" if i in slopes else f"{'-':>8}"
+        lines.append(f"{format_size(size):>8}{reference_times[i]:>12.4f}{times[i]:>12.4f}{slope}")
+    lines.append(
+        f"(CPU seconds, fixed costs of {overhead:.4f}s, {reference_overhead:.4f}s for the reference, excluded)"
+    )
+
+    exponent = fit_exponent([sizes[i] for i in measurable], [times[i] for i in measurable])
+    reference_exponent = fit_exponent(sizes, reference_times)
+    limit = max(1.0, reference_exponent or 1.0) + plan.tolerance
+    superlinear = next((j for j in sorted(slopes) if slopes[j] > limit), None)
+    reference = "" if reference_exponent is None else f", reference n^{reference_exponent:.2f}"
+    if failure is not None:
+        verdict, success = failure, False
+    elif superlinear is not None:
+        previous = measurable[measurable.index(superlinear) - 1]
+        verdict = f"superlinear (n^{slopes[superlinear]:.2f}) beyond {format_size(sizes[previous])}{reference}"
+        success = False
+    elif exponent is None:
+        verdict, success = "too fast to measure growth", True
+    else:
+        verdict, success = f"scales like n^{exponent:.2f}{reference}", True
+    lines.append(f"verdict: {verdict}")
+
+    stats = {"overhead": overhead}
+    if exponent is not None:
+        stats["exponent"] = exponent
+    if reference_exponent is not None:
+        stats["reference_exponent"] = reference_exponent
+    stats.update({f"time_{format_size(size)}": t for size, t in zip(sizes, times, strict=True)})
+    stats.update({f"slope_{format_size(sizes[i])}": slope for i, slope in slopes.items()})
+    return JudgeResult("scaling", success, "\n".join(lines), stats=stats)
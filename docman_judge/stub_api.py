@@ -0,0 +1,88 @@
+import argparse
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A local stand-in for the metadata API, answering `/isbn/<isbn>` and `/title/<url>` with made-up but
+# deterministic metadata, optionally after `latency` seconds. Meant for benchmarks and offline checks:
+#
+#     with StubApi() as api:
+#         LookupCache(endpoint=api.endpoint)
+class StubApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0) -> None:
+        stub = self
+        self.latency = latency
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+                kind, _, key = self.path.lstrip("/").partition("/")
+                key = urllib.parse.unquote(key)
+                if kind == "isbn":
+                    payload = {
+                        "author": f"Author of {key}",
+                        "title": f"Book {key}",
+                        "publisher": "Stub",
+                        "year": "2024",
+                    }
+                elif kind == "title":
+                    payload = {"title": f"Page at {key}"}
+                else:
+                    payload = {"error": "not found"}
+                data = json.dumps(payload).encode()
+                self.send_response(200 if "error" not in payload else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubApi":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "StubApi":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Docman metadata API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before every response")
+    args = parser.parse_args()
+
+    api = StubApi(args.host, args.port, args.latency)
+    print(f"Serving on {api.endpoint}", flush=True)
+    api.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
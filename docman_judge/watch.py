@@ -0,0 +1,68 @@
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Set, Tuple, Union
+
+from docman_judge.cases import Case, MalformedCase
+from docman_judge.judge import JudgeResult, source_files
+from docman_judge.log import TermLogger
+
+if TYPE_CHECKING:
+    from docman_judge.main import JudgeOptions
+
+
+# (modification time, size) of every source file of the workspace, which is all polling needs to compare.
+def source_snapshot(path: str) -> Dict[str, Tuple[int, int]]:
+    snapshot = {}
+    for file_path in source_files(path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:  # removed while walking
+            continue
+        snapshot[file_path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+# Blocks until the sources differ from `snapshot` and then stay unchanged for `settle` seconds,
+# so an editor saving several files at once triggers a single run. Returns the new snapshot.
+def wait_for_change(
+    path: str, snapshot: Dict[str, Tuple[int, int]], interval: float = 0.5, settle: float = 0.3
+) -> Dict[str, Tuple[int, int]]:
+    while (current := source_snapshot(path)) == snapshot:
+        time.sleep(interval)
+    while True:
+        time.sleep(settle)
+        latest = source_snapshot(path)
+        if latest == current:
+            return latest
+        current = latest
+
+
+# Tells which cases failed in the last run, to run them first the next time.
+class WatchLogger(TermLogger):
+    def __init__(self) -> None:
+        super().__init__(live=True, exit_on_failure=False)
+        self.failed: Set[str] = set()
+
+    def log(self, result: JudgeResult) -> bool:
+        if result.case is not None and not result.success:
+            self.failed.add(result.case)
+        return super().log(result)
+
+
+# Judges `path` again every time its sources change, with the case set and answers computed once.
+# The build is incremental, and the cases failed last time run first, then the rest.
+def watch(path: str, cases: List[Union[Case, MalformedCase]], options: "JudgeOptions", interval: float = 0.5) -> None:
+    from docman_judge.main import judge  # main imports this module for its --watch option
+
+    logger = WatchLogger()
+    logger.total = len(cases)
+    snapshot = source_snapshot(path)
+    try:
+        while True:
+            failed, logger.failed = logger.failed, set()
+            ordered = sorted(cases, key=lambda case: case.name not in failed)
+            judge(path, ordered, logger, options)
+            print(f"Watching {path} for changes, Ctrl-C to stop...", flush=True)
+            snapshot = wait_for_change(path, snapshot, interval)
+    except KeyboardInterrupt:
+        print()